@@ -0,0 +1,58 @@
+# Microbenchmark for the per-call cost of the DXGI format queries used by the export hot path
+# (InputLayoutElement.pad/clip/size/is_float/is_int), comparing the old regex based implementation with the
+# precompiled dxgi_format() descriptors.
+# Runs outside of Blender, only numpy is needed:  python benchmarks/dxgi_format_benchmark.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migoto.migoto_utils import components_pattern, misc_float_pattern, misc_int_pattern, dxgi_format
+
+FORMATS = (
+    'DXGI_FORMAT_R32G32B32_FLOAT',
+    'DXGI_FORMAT_R16G16B16A16_FLOAT',
+    'DXGI_FORMAT_R8G8B8A8_UNORM',
+    'DXGI_FORMAT_R32G32B32A32_UINT',
+)
+
+
+def regex_queries(fmt):
+    len(components_pattern.findall(fmt))
+    sum(map(int, components_pattern.findall(fmt))) // 8
+    misc_float_pattern.match(fmt)
+    misc_int_pattern.match(fmt)
+
+
+def descriptor_queries(fmt):
+    descriptor = dxgi_format(fmt)
+    descriptor.components
+    descriptor.size
+    descriptor.is_float
+    descriptor.is_int
+
+
+def held_descriptor_queries(descriptor):
+    # What InputLayoutElement does now, it keeps the descriptor so not even the registry lookup is needed
+    descriptor.components
+    descriptor.size
+    descriptor.is_float
+    descriptor.is_int
+
+
+def main(number=200000):
+    for fmt in FORMATS:
+        descriptor = dxgi_format(fmt)
+        results = (
+            ('regex', timeit.timeit(lambda: regex_queries(fmt), number=number)),
+            ('registry lookup', timeit.timeit(lambda: descriptor_queries(fmt), number=number)),
+            ('held descriptor', timeit.timeit(lambda: held_descriptor_queries(descriptor), number=number)),
+        )
+        print(fmt)
+        for name, seconds in results:
+            print('  %-16s %8.1f ns/call' % (name, seconds / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 from .migoto_format import *
+from .migoto_optimize import *
+from .migoto_output import *
 
 import json
+import hashlib
+import contextlib
 import os.path
+import numpy
+import concurrent.futures
 import bpy
 
 from bpy_extras.io_utils import ExportHelper
@@ -18,57 +24,123 @@ def mesh_triangulate(me):
     bm.free()
 
 
-def blender_vertex_to_3dmigoto_vertex(mesh, obj, blender_loop_vertex, layout, texcoords):
+def foreach_get_array(collection, attribute, components, dtype=numpy.float32):
+    """Reads one attribute of every item of a bpy collection with a single foreach_get"""
+    data = numpy.empty(len(collection) * components, dtype=dtype)
+    collection.foreach_get(attribute, data)
+    return data.reshape(len(collection), components)
 
-    # 根据循环顶点中的顶点索引来从总的顶点中获取对应的顶点
-    blender_vertex = mesh.vertices[blender_loop_vertex.vertex_index]
-    vertex = {}
+
+def pad_columns(data, components, value):
+    """Array version of InputLayoutElement.pad, appends columns filled with value (scalar or per row)"""
+    padding = components - data.shape[1]
+    assert (padding >= 0)
+    if padding == 0:
+        return data
+    fill = numpy.empty((len(data), padding), dtype=numpy.result_type(data, numpy.asarray(value)))
+    fill[:] = numpy.asarray(value).reshape(-1, 1) if numpy.ndim(value) else value
+    return numpy.concatenate((data, fill), axis=1)
+
+
+def texcoord_flips_v(obj, uv_name):
+    try:
+        return bool(obj['3DMigoto:' + uv_name]['flip_v'])
+    except KeyError:
+        return False
+
+
+def gather_skinning(mesh, layout, normalize_weights=False, weight_threshold=0.0):
+    """
+    Reads every vertex group membership of the mesh in one pass and keeps the strongest influences of each
+    vertex that the BLENDINDICES elements of the layout have room for. Returns per vertex (V, K) blend
+    indices and blend weights.
+    """
+    influences = max(elem.SemanticIndex * 4 + elem.dxgi_format.components
+                     for elem in layout if elem.name.startswith('BLENDINDICES') or elem.name.startswith('BLENDWEIGHT'))
+    counts = numpy.fromiter((len(v.groups) for v in mesh.vertices), dtype=numpy.int64, count=len(mesh.vertices))
+    vertex = numpy.repeat(numpy.arange(len(mesh.vertices)), counts)
+    group = numpy.fromiter((x.group for v in mesh.vertices for x in v.groups), dtype=numpy.int64, count=len(vertex))
+    weight = numpy.fromiter((x.weight for v in mesh.vertices for x in v.groups), dtype=numpy.float32, count=len(vertex))
+
+    indices, weights, overflow = top_influences(vertex, group, weight, len(mesh.vertices), influences,
+                                                normalize_weights, weight_threshold)
+    if overflow:
+        print('WARNING: %i vertices are in more than %i vertex groups with weight > 0, only the strongest %i are exported'
+              % (overflow, influences, influences))
+    return indices, weights
+
+
+def gather_loop_attribute_readers(mesh, obj, layout, normalize_weights=False, weight_threshold=0.0):
+    """One function per semantic that returns the rows of the given loop indices, per vertex data stays per vertex"""
+    loop_vertex_index = foreach_get_array(mesh.loops, 'vertex_index', 1, numpy.int32).ravel()
+    readers = collections.OrderedDict()
     seen_offsets = set()
+    skinning = None
+
+    def per_vertex(data):
+        return lambda loops: data[loop_vertex_index[loops]]
 
-    # TODO: Warn if vertex is in too many vertex groups for this layout,
-    # ignoring groups with weight=0.0
-    vertex_groups = sorted(blender_vertex.groups, key=lambda x: x.weight, reverse=True)
+    def per_loop(data, components, value):
+        return lambda loops: pad_columns(data[loops], components, value[loops] if numpy.ndim(value) else value)
+
+    def texcoords(layers):
+        def read(loops):
+            uvs = []
+            for uv, flip_v in layers:
+                uv = uv[loops].astype(numpy.float64)
+                if flip_v:
+                    uv[:, 1] = 1.0 - uv[:, 1]
+                uvs.append(uv)
+            if uvs:
+                return numpy.concatenate(uvs, axis=1)
+            return numpy.empty((len(loops), 0), dtype=numpy.float64)
+        return read
 
     for elem in layout:
         # 只处理per-vertex的
         if elem.InputSlotClass != 'per-vertex':
             continue
 
-        # 用于跳过在同一个顶点上重复元素的处理，这个代码真的会被执行到吗？看起来永远不会触发。
+        # 用于跳过在同一个顶点上重复元素的处理
         if (elem.InputSlot, elem.AlignedByteOffset) in seen_offsets:
             continue
         seen_offsets.add((elem.InputSlot, elem.AlignedByteOffset))
 
+        components = elem.dxgi_format.components
         if elem.name == 'POSITION':
-            vertex[elem.name] = elem.pad(list(blender_vertex.undeformed_co), 1.0)
+            positions = foreach_get_array(mesh.vertices, 'undeformed_co', 3)
+            readers[elem.name] = per_vertex(pad_columns(positions, components, 1.0))
         elif elem.name.startswith('COLOR'):
             if elem.name in mesh.vertex_colors:
-                vertex[elem.name] = elem.clip(list(mesh.vertex_colors[elem.name].data[blender_loop_vertex.index].color))
+                colors = foreach_get_array(mesh.vertex_colors[elem.name].data, 'color', 4)
+                readers[elem.name] = per_loop(colors[:, :components], components, 0.0)
             else:
-                vertex[elem.name] = list(mesh.vertex_colors[elem.name + '.RGB'].data[blender_loop_vertex.index].color)[
-                                    :3] + \
-                                    [mesh.vertex_colors[elem.name + '.A'].data[blender_loop_vertex.index].color[0]]
+                rgb = foreach_get_array(mesh.vertex_colors[elem.name + '.RGB'].data, 'color', 4)
+                alpha = foreach_get_array(mesh.vertex_colors[elem.name + '.A'].data, 'color', 4)
+                readers[elem.name] = per_loop(numpy.concatenate((rgb[:, :3], alpha[:, :1]), axis=1), 4, 0.0)
         elif elem.name == 'NORMAL':
-            vertex[elem.name] = elem.pad(list(blender_loop_vertex.normal), 0.0)
+            readers[elem.name] = per_loop(foreach_get_array(mesh.loops, 'normal', 3), components, 0.0)
         elif elem.name.startswith('TANGENT'):
             # DOAXVV has +1/-1 in the 4th component. Not positive what this is,
             # but guessing maybe the bitangent sign? Not even sure it is used...
             # FIXME: Other games
-            vertex[elem.name] = elem.pad(list(blender_loop_vertex.tangent), blender_loop_vertex.bitangent_sign)
-        elif elem.name.startswith('BLENDINDICES'):
+            tangents = foreach_get_array(mesh.loops, 'tangent', 3)
+            bitangent_sign = foreach_get_array(mesh.loops, 'bitangent_sign', 1).ravel()
+            readers[elem.name] = per_loop(tangents, components, bitangent_sign)
+        elif elem.name.startswith('BLENDINDICES') or elem.name.startswith('BLENDWEIGHT'):
+            if skinning is None:
+                skinning = gather_skinning(mesh, layout, normalize_weights, weight_threshold)
             i = elem.SemanticIndex * 4
-            vertex[elem.name] = elem.pad([x.group for x in vertex_groups[i:i + 4]], 0)
-        elif elem.name.startswith('BLENDWEIGHT'):
-            # TODO: Warn if vertex is in too many vertex groups for this layout
-            i = elem.SemanticIndex * 4
-            vertex[elem.name] = elem.pad([x.weight for x in vertex_groups[i:i + 4]], 0.0)
+            data = skinning[0] if elem.name.startswith('BLENDINDICES') else skinning[1]
+            readers[elem.name] = per_vertex(pad_columns(data[:, i:i + components], components, 0))
         elif elem.name.startswith('TEXCOORD') and elem.is_float():
             # FIXME: Handle texcoords of other dimensions
-            uvs = []
+            layers = []
             for uv_name in ('%s.xy' % elem.name, '%s.zw' % elem.name):
-                if uv_name in texcoords:
-                    uvs += list(texcoords[uv_name][blender_loop_vertex.index])
-            vertex[elem.name] = uvs
+                if uv_name in mesh.uv_layers:
+                    layers.append((foreach_get_array(mesh.uv_layers[uv_name].data, 'uv', 2),
+                                   texcoord_flips_v(obj, uv_name)))
+            readers[elem.name] = texcoords(layers)
 
         # Nico: 不需要考虑BINORMAL，现代游戏的渲染基本上不会使用BINORMAL这种过时的渲染方案
         # elif elem.name.startswith('BINORMAL'):
@@ -78,13 +150,9 @@ def blender_vertex_to_3dmigoto_vertex(mesh, obj, blender_loop_vertex, layout, te
             # we can really deal with at all. Therefore, the below is untested,
             # FIXME: So find a mesh where this is actually the binormal,
             # uncomment the below code and test.
-            # normal = blender_loop_vertex.normal
-            # tangent = blender_loop_vertex.tangent
             # binormal = numpy.cross(normal, tangent)
             # XXX: Does the binormal need to be normalised to a unit vector?
             # binormal = binormal / numpy.linalg.norm(binormal)
-            # vertex[elem.name] = elem.pad(list(binormal), 0.0)
-            # pass
 
         else:
             # Unhandled semantics are saved in vertex layers
@@ -92,19 +160,105 @@ def blender_vertex_to_3dmigoto_vertex(mesh, obj, blender_loop_vertex, layout, te
             for component in 'xyzw':
                 layer_name = '%s.%s' % (elem.name, component)
                 if layer_name in mesh.vertex_layers_int:
-                    data.append(mesh.vertex_layers_int[layer_name].data[blender_loop_vertex.vertex_index].value)
+                    data.append(foreach_get_array(mesh.vertex_layers_int[layer_name].data, 'value', 1, numpy.int32))
                 elif layer_name in mesh.vertex_layers_float:
-                    data.append(mesh.vertex_layers_float[layer_name].data[blender_loop_vertex.vertex_index].value)
+                    data.append(foreach_get_array(mesh.vertex_layers_float[layer_name].data, 'value', 1))
             if data:
                 # print('Retrieved unhandled semantic %s %s from vertex layer' % (elem.name, elem.Format), data)
-                vertex[elem.name] = data
+                readers[elem.name] = per_vertex(numpy.concatenate(data, axis=1))
 
-        if elem.name not in vertex:
+        if elem.name not in readers:
             print('NOTICE: Unhandled vertex element: %s' % elem.name)
-        # else:
-        #    print('%s: %s' % (elem.name, repr(vertex[elem.name])))
 
-    return vertex
+    return readers
+
+
+def gather_loop_attributes(mesh, obj, layout, normalize_weights=False, weight_threshold=0.0, loops=None):
+    """One array per semantic with a row for each of the given loops, all loops by default"""
+    if loops is None:
+        loops = numpy.arange(len(mesh.loops))
+    readers = gather_loop_attribute_readers(mesh, obj, layout, normalize_weights, weight_threshold)
+    return collections.OrderedDict((semantic, read(loops)) for semantic, read in readers.items())
+
+
+def weld_steps(mmt_props):
+    """The per semantic weld tolerances from the export settings, in the form weld_vertices takes them"""
+    return [('POSITION', ('POSITION',), mmt_props.export_weld_position),
+            ('NORMAL', ('NORMAL', 'TANGENT'), mmt_props.export_weld_normal),
+            ('TEXCOORD', ('TEXCOORD',), mmt_props.export_weld_texcoord)]
+
+
+def triangulated_loop_order(mesh):
+    """The loops of a triangulated mesh in polygon order, which is the order the index buffer is written in"""
+    loop_start = foreach_get_array(mesh.polygons, 'loop_start', 1, numpy.int32).ravel()
+    loop_total = foreach_get_array(mesh.polygons, 'loop_total', 1, numpy.int32).ravel()
+    assert (numpy.all(loop_total == 3))
+    return (loop_start.reshape(-1, 1) + numpy.arange(3, dtype=numpy.int32)).ravel()
+
+
+def restore_vertex_numbering(operator, obj, mesh, vb, ib, vertex_blender_indices):
+    """
+    Undoes the compact_vertices import option: every exported vertex goes back to the index it had in the
+    original vertex buffer, the vertices the import removed are left zero filled. Only possible when every
+    Blender vertex was exported as exactly one vertex, vertex_blender_indices is the Blender vertex every
+    exported vertex came from. Returns whether the numbering was restored.
+    """
+    try:
+        remap = numpy.array(obj['3DMigoto:VertexRemap'], dtype=numpy.int64)
+        original_vertex_count = obj['3DMigoto:OriginalVertexCount']
+    except KeyError:
+        operator.report({'WARNING'}, '%s was imported without removing unused vertices, nothing to restore' % obj.name)
+        return False
+
+    if len(mesh.vertices) != len(remap) or len(vertex_blender_indices) != len(remap) or \
+            len(numpy.unique(vertex_blender_indices)) != len(remap):
+        operator.report({'WARNING'}, 'Exported vertices of %s no longer match the imported ones one to one, '
+                                     'the original vertex numbering can not be restored' % obj.name)
+        return False
+
+    original = remap[vertex_blender_indices]
+    columns = collections.OrderedDict()
+    for semantic, data in vb.columns.items():
+        columns[semantic] = numpy.zeros((original_vertex_count,) + data.shape[1:], dtype=data.dtype)
+        columns[semantic][original] = data
+    vb.set_columns(columns)
+    ib.faces = original[ib.faces]
+    operator.report({'INFO'}, 'Restored the original numbering of %i vertices in a %i vertex buffer'
+                    % (len(remap), original_vertex_count))
+    return True
+
+
+def shrink_index_buffer(operator, vb, ib, chunking):
+    """
+    Picks the smallest index format the vertex count allows. A mesh with too many vertices for R16 is
+    either exported with R32, or with chunking split into several R16 draw calls, see split_index_buffer.
+    """
+    legacy_bytes = len(ib) * 4
+    vertex_count = len(vb)
+    shrunk = IndexBuffer(smallest_index_format(vertex_count))
+    shrunk.faces = ib.faces
+    if shrunk.format != 'DXGI_FORMAT_R16_UINT' and chunking:
+        positions = vb.columns.get('POSITION')
+        if positions is None:
+            positions = numpy.zeros((vertex_count, 3))
+        vertex_map, faces, chunks = split_index_buffer(ib.faces, positions)
+        vb.set_columns(collections.OrderedDict((semantic, data[vertex_map]) for semantic, data in vb.columns.items()))
+        shrunk = IndexBuffer('DXGI_FORMAT_R16_UINT')
+        shrunk.faces = faces
+        shrunk.chunks = chunks
+        operator.report({'INFO'}, 'Split into %i R16 draw calls, %i vertices duplicated on chunk borders'
+                        % (len(chunks), len(vb) - vertex_count))
+
+    ib_bytes = len(shrunk) * dxgi_format(shrunk.format).size
+    operator.report({'INFO'}, 'IB format %s: %i bytes, %i bytes saved compared to R32_UINT'
+                    % (shrunk.format, ib_bytes, legacy_bytes - ib_bytes))
+    return shrunk
+
+
+def write_vgmap_variant(vb, records, lut, path, diff_log=False):
+    with AtomicOutput(path, 'wb', diff_log) as f:
+        f.write(vb.encode_blendindices_remap(records, lut).tobytes())
+    return path
 
 
 def write_fmt_file(f, vb, ib):
@@ -112,9 +266,89 @@ def write_fmt_file(f, vb, ib):
     f.write('topology: %s\n' % vb.topology)
     if ib is not None:
         f.write('format: %s\n' % ib.format)
+        for i, chunk in enumerate(ib.chunks):
+            f.write('draw[%i]: first index: %i, index count: %i, base vertex: %i, vertex count: %i\n' % ((i,) + tuple(chunk)))
     f.write(vb.layout.to_string())
 
 
+def id_property_value(value):
+    """Plain python value of a custom property, IDPropertyGroup/IDPropertyArray can't be serialised directly"""
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    if hasattr(value, 'to_list'):
+        return value.to_list()
+    # 例如3DMigoto:VBLayout，Blender返回的是IDPropertyGroup组成的普通list
+    if isinstance(value, (list, tuple)):
+        return [id_property_value(x) for x in value]
+    return value
+
+
+def export_settings(mmt_props):
+    """Every export_* setting of the MMT panel, used to decide whether an earlier export is still valid"""
+    names = sorted(prop.identifier for prop in mmt_props.bl_rna.properties if prop.identifier.startswith('export_'))
+    return {name: getattr(mmt_props, name) for name in names}
+
+
+def export_fingerprint(context, obj):
+    """
+    Cheap content fingerprint of everything export_3dmigoto's output depends on: the evaluated mesh data,
+    the modifier stack, the 3DMigoto custom properties and the export settings. Reading the evaluated
+    arrays is much faster than triangulating, calculating tangents and encoding the mesh.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+
+    def update(data):
+        fingerprint.update(numpy.ascontiguousarray(data).tobytes())
+
+    properties = {k: id_property_value(v) for k, v in obj.items() if k.startswith('3DMigoto:')}
+    modifiers = [(m.name, m.type, m.show_viewport) for m in obj.modifiers]
+    settings = export_settings(context.scene.mmt_props)
+    fingerprint.update(json.dumps([properties, modifiers, settings], sort_keys=True).encode('utf-8'))
+
+    evaluated = obj.evaluated_get(context.evaluated_depsgraph_get())
+    mesh = evaluated.to_mesh()
+    try:
+        update(foreach_get_array(mesh.vertices, 'co', 3))
+        update(foreach_get_array(mesh.loops, 'vertex_index', 1, numpy.int32))
+        update(foreach_get_array(mesh.polygons, 'loop_start', 1, numpy.int32))
+        update(foreach_get_array(mesh.polygons, 'loop_total', 1, numpy.int32))
+        if hasattr(mesh, 'calc_normals_split'):
+            mesh.calc_normals_split()
+        update(foreach_get_array(mesh.loops, 'normal', 3))
+        for uv_layer in mesh.uv_layers:
+            fingerprint.update(uv_layer.name.encode('utf-8'))
+            update(foreach_get_array(uv_layer.data, 'uv', 2))
+        for color_layer in mesh.vertex_colors:
+            fingerprint.update(color_layer.name.encode('utf-8'))
+            update(foreach_get_array(color_layer.data, 'color', 4))
+        for layers in (mesh.vertex_layers_int, mesh.vertex_layers_float):
+            for layer in layers:
+                fingerprint.update(layer.name.encode('utf-8'))
+                update(foreach_get_array(layer.data, 'value', 1, numpy.int32 if layers is mesh.vertex_layers_int else numpy.float32))
+        fingerprint.update(json.dumps([vertex_group.name for vertex_group in obj.vertex_groups]).encode('utf-8'))
+        update(numpy.array([(v.index, x.group, x.weight) for v in mesh.vertices for x in v.groups], dtype=numpy.float64))
+    finally:
+        evaluated.to_mesh_clear()
+    return fingerprint.hexdigest()
+
+
+# 每个输出文件夹下记录上次导出时每个部位的指纹，用于一键导出时跳过没有改动的部位
+EXPORT_MANIFEST_NAME = 'MMTExportManifest.json'
+
+
+def load_export_manifest(folder):
+    try:
+        with open(os.path.join(folder, EXPORT_MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_export_manifest(folder, manifest):
+    with AtomicOutput(os.path.join(folder, EXPORT_MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
 def export_3dmigoto(operator, context, vb_path, ib_path, fmt_path):
 
     operator.report({'INFO'}, "导出是否保持相同顶点数：" + str(bpy.context.scene.mmt_props.export_same_number))
@@ -130,14 +364,30 @@ def export_3dmigoto(operator, context, vb_path, ib_path, fmt_path):
 
     # 获取Mesh
     if hasattr(context, "evaluated_depsgraph_get"):  # 2.80
-        mesh = obj.evaluated_get(context.evaluated_depsgraph_get()).to_mesh()
+        evaluated = obj.evaluated_get(context.evaluated_depsgraph_get())
+        mesh = evaluated.to_mesh()
     else:  # 2.79
+        evaluated = None
         mesh = obj.to_mesh(context.scene, True, 'PREVIEW', calc_tessface=False)
 
+    # 导出完成或者出错时都立刻释放求值得到的mesh，不要留到下一次depsgraph更新
+    try:
+        export_3dmigoto_mesh(operator, obj, mesh, layout, vb_path, ib_path, fmt_path)
+    finally:
+        if evaluated is not None:
+            evaluated.to_mesh_clear()
+        else:
+            bpy.data.meshes.remove(mesh)
+
+
+def export_3dmigoto_mesh(operator, obj, mesh, layout, vb_path, ib_path, fmt_path):
     # 使用bmesh复制出一个新mesh并三角化
     mesh_triangulate(mesh)
 
+    mmt_props = bpy.context.scene.mmt_props
+    diff_log = mmt_props.export_log_byte_diff
     try:
+        # LEGACY模式下R16总是改为R32导出，SMALLEST模式会在去重之后根据顶点数重新选择
         if obj['3DMigoto:IBFormat'] == "DXGI_FORMAT_R16_UINT":
             ib_format = "DXGI_FORMAT_R32_UINT"
         else:
@@ -153,84 +403,88 @@ def export_3dmigoto(operator, context, vb_path, ib_path, fmt_path):
     # 这一步如果存在TANGENT属性则会导致顶点数量增加
     mesh.calc_tangents()
 
-    # 拼凑texcoord层级，有几个UVMap就拼出几个来
-    texcoord_layers = {}
-    for uv_layer in mesh.uv_layers:
-        texcoords = {}
-
-        try:
-            flip_texcoord_v = obj['3DMigoto:' + uv_layer.name]['flip_v']
-            if flip_texcoord_v:
-                flip_uv = lambda uv: (uv[0], 1.0 - uv[1])
-            else:
-                flip_uv = lambda uv: uv
-        except KeyError:
-            flip_uv = lambda uv: uv
-
-        for l in mesh.loops:
-            uv = flip_uv(uv_layer.data[l.index].uv)
-            texcoords[l.index] = uv
-        texcoord_layers[uv_layer.name] = texcoords
+    if mmt_props.export_streaming:
+        export_3dmigoto_streaming(operator, obj, mesh, layout, ib, vb_path, ib_path, fmt_path)
+        return
 
     # Blender's vertices have unique positions, but may have multiple
     # normals, tangents, UV coordinates, etc - these are stored in the
     # loops. To export back to DX we need these combined together such that
     # a vertex is a unique set of all attributes, but we don't want to
     # completely blow this out - we still want to reuse identical vertices
-    # via the index buffer. There might be a convenience function in
-    # Blender to do this, but it's easy enough to do this ourselves
-    indexed_vertices = collections.OrderedDict()
-
-    unique_position_vertices = {}
+    # via the index buffer. All loop attributes are read in bulk and merged
+    # with deduplicate_vertices, which numbers the vertices in the order
+    # they are first seen.
     '''
     Nico:
         顶点转换为3dmigoto类型的顶点再经过hashable后，如果存在TANGENT则会导致数量变多，不存在则不会导致数量变多。
         Nico: 初始的Vertex即使是经过TANGENT计算，数量也是和原来一样的
-        但是这里使用了blender_lvertex导致了生成的HashableVertex不一样，因为其它都是固定的只有这个blender_lvertex会改变
+        但是这里使用了blender_lvertex导致了生成的去重顶点不一样，因为其它都是固定的只有这个blender_lvertex会改变
         需要注意的是如果不计算TANGENT或者没有TANGENT属性时不会额外生成顶点
     '''
-    for poly in mesh.polygons:
-        face = []
-        for blender_lvertex in mesh.loops[poly.loop_start:poly.loop_start + poly.loop_total]:
-            #
-            vertex = blender_vertex_to_3dmigoto_vertex(mesh, obj, blender_lvertex, layout, texcoord_layers)
-
-            '''
-            Nico:
-                首先将当前顶点计算为Hash后的顶点然后如果该计算后的Hash顶点不存在，则插入到indexed_vertices里
-                随后将该顶点添加到face[]里，索引为该顶点在字典里的索引
-                这里我们把获取到的vertex的切线加到一个vertex:切线值的字典中
-                如果vertex的顶点在字典中出现了，则返回字典中对应列表和当前值的平均值，否则不进行更新
-                这样就能得到每个Position对应的平均切线，在切线值相同的情况下，就不会产生额外的多余顶点了。
-                这里我选择简单的使用这个顶点第一次出现的TANGENT作为它的TANGENT，以此避免产生额外多余顶点的问题，后续可以优化为使用平均值作为TANGENT
-            '''
-            if bpy.context.scene.mmt_props.export_same_number:
-                if "POSITION" in vertex and "NORMAL" in vertex and "TANGENT" in vertex :
-                    if tuple(vertex["POSITION"] + vertex["NORMAL"]  ) in unique_position_vertices:
-                        tangent_var = unique_position_vertices[tuple(vertex["POSITION"] + vertex["NORMAL"])]
-                        vertex["TANGENT"] = tangent_var
-                    else:
-                        tangent_var = vertex["TANGENT"]
-                        unique_position_vertices[tuple(vertex["POSITION"] + vertex["NORMAL"])] = tangent_var
-                        vertex["TANGENT"] = tangent_var
-
-            indexed_vertex = indexed_vertices.setdefault(HashableVertex(vertex), len(indexed_vertices))
-            face.append(indexed_vertex)
-        if ib is not None:
-            ib.append(face)
-
-    # operator.report({'INFO'}, "Export Vertex Number: " + str(len(indexed_vertices)))
+    loop_order = triangulated_loop_order(mesh)
+    loop_columns = gather_loop_attributes(mesh, obj, layout, mmt_props.export_normalize_weights,
+                                          mmt_props.export_weight_threshold, loop_order)
+
+    if bpy.context.scene.mmt_props.export_same_number:
+        unify_tangents(loop_columns, mmt_props.export_tangent_mode)
+
+    # 所有的面在三角化之后都是三角形，所以去重后每个loop对应的顶点索引按顺序每三个就是一个面
+    vertex_loops, loop_vertex_indices, saved = weld_vertices(loop_columns, weld_steps(mmt_props))
+    for label, count in saved:
+        operator.report({'INFO'}, '%s weld tolerance saved %i vertices' % (label, count))
+    if ib is not None:
+        ib.faces = loop_vertex_indices
+
+    # operator.report({'INFO'}, "Export Vertex Number: " + str(len(vertex_loops)))
     vb = VertexBuffer(layout=layout)
-    for vertex in indexed_vertices:
-        vb.append(vertex)
+    vb.set_columns(collections.OrderedDict((semantic, data[vertex_loops]) for semantic, data in loop_columns.items()))
+
+    restored = False
+    if ib is not None and mmt_props.export_restore_vertex_numbering:
+        loop_vertex_index = foreach_get_array(mesh.loops, 'vertex_index', 1, numpy.int32).ravel()
+        restored = restore_vertex_numbering(operator, obj, mesh, vb, ib, loop_vertex_index[loop_order][vertex_loops])
+
+    # 分块会重新排列并复制顶点，还原后的原始编号就没有意义了，所以还原编号时不分块
+    chunking = mmt_props.export_ib_chunking
+    if ib is not None and mmt_props.export_ib_format == 'SMALLEST' and chunking and restored:
+        operator.report({'WARNING'}, 'Vertices keep their restored original numbering, the index buffer is not split into R16 draw calls')
+        chunking = False
+
+    if ib is not None and mmt_props.export_ib_format == 'SMALLEST':
+        ib = shrink_index_buffer(operator, vb, ib, chunking)
+
+    # 只改变三角形的顺序，不会改变顶点数量，所以和export_same_number可以一起使用
+    if ib is not None and mmt_props.export_optimize_vertex_cache:
+        acmr, atvr = vertex_cache_statistics(ib.faces)
+        ib.faces = optimize_vertex_cache(ib.faces, ib.chunks, len(vb))
+        optimized_acmr, optimized_atvr = vertex_cache_statistics(ib.faces)
+        operator.report({'INFO'}, 'Vertex cache optimized: ACMR %.3f -> %.3f, ATVR %.3f -> %.3f'
+                        % (acmr, optimized_acmr, atvr, optimized_atvr))
+
+    # 按照IB中第一次使用的顺序重新排列顶点，在编码之前处理，这样所有vgmap变体使用的都是同一个顺序
+    if ib is not None and mmt_props.export_reorder_vertices and restored:
+        operator.report({'WARNING'}, 'Vertices keep their restored original numbering and are not reordered')
+    elif ib is not None and mmt_props.export_reorder_vertices:
+        new_to_old, ib.faces = reorder_vertices_by_first_use(ib.faces, len(vb))
+        vb.set_columns(collections.OrderedDict((semantic, data[new_to_old]) for semantic, data in vb.columns.items()))
+        remap_path = os.path.splitext(vb_path)[0] + '.vbremap.json'
+        with AtomicOutput(remap_path, 'w', diff_log) as f:
+            json.dump({'new_to_old': new_to_old.tolist()}, f)
+        operator.report({'INFO'}, 'Vertices reordered by first use, permutation written to ' + remap_path)
 
     vgmaps = {k[15:]: keys_to_ints(v) for k, v in obj.items() if k.startswith('3DMigoto:VGMap:')}
     # operator.report({'INFO'}, "vgmap length " + str(len(vgmaps)))
 
+    # 顶点只编码一次，每个vgmap只需要在这份编码结果的副本上重新写入BLENDINDICES
+    records = vb.encode()
     if '' not in vgmaps:
-        vb.write(open(vb_path, 'wb'), operator=operator)
+        with AtomicOutput(vb_path, 'wb', diff_log) as f:
+            vb.write(f, operator=operator, records=records)
 
+    # 查找表要访问obj.vertex_groups，所以在主线程里生成，写文件交给线程池并行处理
     base, ext = os.path.splitext(vb_path)
+    variants = []
     for (suffix, vgmap) in vgmaps.items():
         path = vb_path
         if suffix:
@@ -238,17 +492,106 @@ def export_3dmigoto(operator, context, vb_path, ib_path, fmt_path):
         vgmap_path = os.path.splitext(path)[0] + '.vgmap'
         operator.report({'INFO'}, "vgmap_path " + vgmap_path)
         print('Exporting %s...' % path)
-        vb.remap_blendindices(obj, vgmap)
-        vb.write(open(path, 'wb'), operator=operator)
-        vb.revert_blendindices_remap()
+        variants.append((path, vb.blendindices_lookup_table(obj, vgmap)))
         sorted_vgmap = collections.OrderedDict(sorted(vgmap.items(), key=lambda x: x[1]))
-        json.dump(sorted_vgmap, open(vgmap_path, 'w'), indent=2)
+        with AtomicOutput(vgmap_path, 'w', diff_log) as f:
+            json.dump(sorted_vgmap, f, indent=2)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [executor.submit(write_vgmap_variant, vb, records, lut, path, diff_log) for path, lut in variants]
+        for future in futures:
+            operator.report({'INFO'}, 'Wrote %i vertices to %s' % (len(vb), future.result()))
 
     if ib is not None:
-        ib.write(open(ib_path, 'wb'), operator=operator)
+        with AtomicOutput(ib_path, 'wb', diff_log) as f:
+            ib.write(f, operator=operator)
+
+    # Write format reference file
+    with AtomicOutput(fmt_path, 'w', diff_log) as f:
+        write_fmt_file(f, vb, ib)
+
+
+def export_3dmigoto_streaming(operator, obj, mesh, layout, ib, vb_path, ib_path, fmt_path):
+    # 超大模型的低内存导出：按块去重并直接写入文件，输出和普通导出完全一样，但不支持需要整个IB的优化选项
+    mmt_props = bpy.context.scene.mmt_props
+    diff_log = mmt_props.export_log_byte_diff
+    chunk_size = max(mmt_props.export_streaming_chunk_size // 3, 1) * 3
+
+    if mmt_props.export_ib_format != 'LEGACY' or mmt_props.export_optimize_vertex_cache or \
+            mmt_props.export_reorder_vertices or mmt_props.export_restore_vertex_numbering:
+        operator.report({'WARNING'}, 'Streaming export ignores the IB format, vertex cache, vertex reorder and '
+                                     'restore vertex numbering options')
+    unify = mmt_props.export_same_number
+    if unify and mmt_props.export_tangent_mode != 'FIRST':
+        operator.report({'WARNING'}, 'Streaming export only supports the FIRST tangent unification mode')
+
+    readers = gather_loop_attribute_readers(mesh, obj, layout, mmt_props.export_normalize_weights,
+                                            mmt_props.export_weight_threshold)
+    loop_order = triangulated_loop_order(mesh)
+    unify = unify and all(semantic in readers for semantic in ("POSITION", "NORMAL", "TANGENT"))
+    tolerances = collections.OrderedDict((prefix, tolerance) for label, prefixes, tolerance in weld_steps(mmt_props)
+                                         if tolerance > 0.0 for prefix in prefixes)
+
+    vgmaps = {k[15:]: keys_to_ints(v) for k, v in obj.items() if k.startswith('3DMigoto:VGMap:')}
+    base, ext = os.path.splitext(vb_path)
+    variants = []
+    if '' not in vgmaps:
+        variants.append((vb_path, None))
+    for (suffix, vgmap) in vgmaps.items():
+        path = vb_path
+        if suffix:
+            path = '%s-%s%s' % (base, suffix, ext)
+        vgmap_path = os.path.splitext(path)[0] + '.vgmap'
+        operator.report({'INFO'}, "vgmap_path " + vgmap_path)
+        variants.append((path, vgmap))
+        sorted_vgmap = collections.OrderedDict(sorted(vgmap.items(), key=lambda x: x[1]))
+        with AtomicOutput(vgmap_path, 'w', diff_log) as f:
+            json.dump(sorted_vgmap, f, indent=2)
+
+    ib_dtype = dxgi_format(ib.format).numpy_dtype()
+    vertex_table = UniqueKeyTable()
+    tangent_table = UniqueKeyTable()
+    first_tangents = None
+    with contextlib.ExitStack() as stack:
+        # 每个vgmap的查找表在第一次用到时生成，之后的块里出现更大的BLENDINDICES时再扩大
+        vb_outputs = [[stack.enter_context(AtomicOutput(path, 'wb', diff_log)), vgmap, None] for path, vgmap in variants]
+        ib_output = stack.enter_context(AtomicOutput(ib_path, 'wb', diff_log))
+        for start in range(0, len(loop_order), chunk_size):
+            chunk_order = loop_order[start:start + chunk_size]
+            chunk = collections.OrderedDict((semantic, read(chunk_order)) for semantic, read in readers.items())
+
+            # 和unify_tangents的FIRST模式一样，每个POSITION+NORMAL使用第一次出现的TANGENT
+            if unify:
+                ids, new = tangent_table.insert(pack_rows(collections.OrderedDict(
+                    (semantic, chunk[semantic]) for semantic in ("POSITION", "NORMAL"))))
+                new_tangents = chunk["TANGENT"][new]
+                first_tangents = new_tangents if first_tangents is None else numpy.concatenate((first_tangents, new_tangents))
+                chunk["TANGENT"] = first_tangents[ids]
+
+            keys = quantize_columns(chunk, tolerances) if tolerances else chunk
+            ids, new = vertex_table.insert(pack_rows(keys))
+            ib_output.write(ids.astype(ib_dtype).tobytes())
+
+            vertices = VertexBuffer(layout=layout)
+            vertices.set_columns(collections.OrderedDict((semantic, data[new]) for semantic, data in chunk.items()))
+            records = vertices.encode()
+            blendindices_size = vertices.blendindices_size()
+            for variant in vb_outputs:
+                output, vgmap, lut = variant
+                if vgmap is None:
+                    output.write(records.tobytes())
+                    continue
+                if lut is None or len(lut) < blendindices_size:
+                    lut = variant[2] = vgmap_lookup_table(obj.vertex_groups, vgmap, blendindices_size)
+                output.write(vertices.encode_blendindices_remap(records, lut).tobytes())
+
+    for path, vgmap in variants:
+        operator.report({'INFO'}, 'Wrote %i vertices to %s' % (len(vertex_table), path))
+    operator.report({'INFO'}, 'Wrote %i indices to %s' % (len(loop_order), ib_path))
 
     # Write format reference file
-    write_fmt_file(open(fmt_path, 'w'), vb, ib)
+    with AtomicOutput(fmt_path, 'w', diff_log) as f:
+        write_fmt_file(f, VertexBuffer(layout=layout), ib)
 
 
 class Export3DMigoto(bpy.types.Operator, ExportHelper):
@@ -1,6 +1,7 @@
 from .migoto_utils import *
 
 import io
+import numpy
 import textwrap
 import collections
 
@@ -20,7 +21,7 @@ class InputLayoutElement(object):
         else:
             self.from_dict(arg)
 
-        self.encoder, self.decoder = EncoderDecoder(self.Format)
+        self.dxgi_format = dxgi_format(self.Format)
 
     def from_file(self, f):
         self.SemanticName = self.next_validate(f, 'SemanticName')
@@ -82,7 +83,7 @@ class InputLayoutElement(object):
 
     def pad(self, data, val):
 
-        padding = format_components(self.Format) - len(data)
+        padding = self.dxgi_format.components - len(data)
         assert (padding >= 0)
         return data + [val] * padding
 
@@ -95,23 +96,16 @@ class InputLayoutElement(object):
 
 
     def clip(self, data):
-        return data[:format_components(self.Format)]
+        return data[:self.dxgi_format.components]
 
     def size(self):
-        return format_size(self.Format)
+        return self.dxgi_format.size
 
     def is_float(self):
-        return misc_float_pattern.match(self.Format)
+        return self.dxgi_format.is_float
 
     def is_int(self):
-        return misc_int_pattern.match(self.Format)
-
-    def encode(self, data):
-        # print(self.Format, data)
-        return self.encoder(data)
-
-    def decode(self, data):
-        return self.decoder(data)
+        return self.dxgi_format.is_int
 
     def __eq__(self, other):
         return \
@@ -124,6 +118,86 @@ class InputLayoutElement(object):
                 self.InstanceDataStepRate == other.InstanceDataStepRate
 
 
+class InputLayoutCodec(object):
+    # An InputLayout compiled into a numpy structured dtype, one field per element at its AlignedByteOffset
+
+    def __init__(self, layout):
+        names = []
+        formats = []
+        offsets = []
+        self.scales = collections.OrderedDict()
+        self.semantic_names = {}
+        for elem in layout:
+            fmt = elem.dxgi_format
+            if elem.AlignedByteOffset + fmt.size > layout.stride:
+                raise Fatal('Element %s at offset %i does not fit in a vertex stride of %i' %
+                            (elem.name, elem.AlignedByteOffset, layout.stride))
+            names.append(elem.name)
+            formats.append((fmt.numpy_dtype(), (fmt.components,)))
+            offsets.append(elem.AlignedByteOffset)
+            self.scales[elem.name] = fmt.scale
+            self.semantic_names[elem.name] = elem.SemanticName
+        # Elements are allowed to alias each other (e.g. COLOR sharing the offset of POSITION), numpy is
+        # fine with overlapping fields as long as none of them are python objects.
+        self.dtype = numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                                  'itemsize': layout.stride})
+
+    def decode(self, buf, count=-1, offset=0):
+        """Returns a read only structured array viewing count vertices of buf starting at offset"""
+        return numpy.frombuffer(buf, dtype=self.dtype, count=count, offset=offset)
+
+    def columns(self, records, semantics=None, scale=True):
+        """
+        Splits decoded records into one (vertex count, components) array per semantic, only the semantics
+        in the optional whitelist (see semantic_selected). Without scale the UNORM/SNORM fields are left as
+        the raw integer views, see VertexBuffer.apply_scales.
+        """
+        columns = collections.OrderedDict()
+        for name, field_scale in self.scales.items():
+            if semantics is not None and name not in semantics and self.semantic_names[name] not in semantics:
+                continue
+            if field_scale is None or not scale:
+                columns[name] = records[name]
+            else:
+                columns[name] = records[name] / field_scale
+        return columns
+
+    def decode_columns(self, buf, count=-1, offset=0, semantics=None, scale=True):
+        return self.columns(self.decode(buf, count, offset), semantics, scale)
+
+    def encode_field(self, records, name, data):
+        """
+        Converts one semantic column to its DXGI format and stores it in records. UNORM/SNORM values are
+        scaled and rounded in float32, everything else is a plain cast.
+        Columns with fewer components than the format only fill the leading components.
+        """
+        field = records[name]
+        data = numpy.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        components = data.shape[1]
+        if components > field.shape[1]:
+            raise Fatal('%s has %i components, but its format only holds %i' % (name, components, field.shape[1]))
+        if components == 0:
+            return
+        scale = self.scales[name]
+        if scale is not None:
+            data = numpy.around(data.astype(numpy.float32) * numpy.float32(scale))
+        field[:, :components] = data.astype(field.dtype)
+
+    def encode(self, columns, count):
+        """Packs per semantic columns into one zero filled structured array of count vertices"""
+        records = numpy.zeros(count, dtype=self.dtype)
+        for name, data in columns.items():
+            self.encode_field(records, name, data)
+        return records
+
+
+# Compiled codecs keyed by the layout signature. export_3dmigoto and show_indexed_vertices rebuild the
+# InputLayout from obj['3DMigoto:VBLayout'] every time, this way they still only compile it once.
+_input_layout_codecs = {}
+
+
 class InputLayout(object):
     def __init__(self, custom_prop=[], stride=0):
         self.elems = collections.OrderedDict()
@@ -152,67 +226,241 @@ class InputLayout(object):
     def __getitem__(self, semantic):
         return self.elems[semantic]
 
-    def encode(self, vertex):
-        buf = bytearray(self.stride)
-
-        for semantic, data in vertex.items():
-            if semantic.startswith('~'):
-                continue
-            elem = self.elems[semantic]
-            data = elem.encode(data)
-            buf[elem.AlignedByteOffset:elem.AlignedByteOffset + len(data)] = data
-
-        assert (len(buf) == self.stride)
-        return buf
+    def signature(self):
+        return (self.stride,) + tuple((elem.name, elem.Format, elem.InputSlot, elem.AlignedByteOffset)
+                                      for elem in self.elems.values())
 
-    def decode(self, buf):
-        vertex = {}
-        for elem in self.elems.values():
-            data = buf[elem.AlignedByteOffset:elem.AlignedByteOffset + elem.size()]
-            vertex[elem.name] = elem.decode(data)
-        return vertex
+    @property
+    def codec(self):
+        # The signature is computed each time rather than cached, as parse_vb_txt fills in the stride and
+        # elements after this layout has been constructed.
+        signature = self.signature()
+        codec = _input_layout_codecs.get(signature)
+        if codec is None:
+            codec = _input_layout_codecs[signature] = InputLayoutCodec(self)
+        return codec
 
     def __eq__(self, other):
         return self.elems == other.elems
 
 
-class HashableVertex(dict):
-    # 旧的代码注释掉了，不过不删，留着用于参考防止忘记原本的设计
-    # def __hash__(self):
-    #     # Convert keys and values into immutable types that can be hashed
-    #     immutable = tuple((k, tuple(v)) for k, v in sorted(self.items()))
-    #     return hash(immutable)
+def pack_rows(columns):
+    """
+    Packs per loop columns into one opaque numpy.void record per loop, so whole loops can be compared with
+    numpy.unique. Records compare equal exactly when python would consider the per loop values equal:
+    floats are compared as float64 with -0.0 folded into 0.0, ints as int64.
+    """
+    parts = []
+    for data in columns.values():
+        data = numpy.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        if data.dtype.kind == 'f':
+            data = data.astype(numpy.float64) + 0.0
+        else:
+            data = data.astype(numpy.int64)
+        parts.append(numpy.ascontiguousarray(data).view(numpy.uint8))
+    packed = numpy.ascontiguousarray(numpy.concatenate(parts, axis=1))
+    return packed.view(numpy.dtype((numpy.void, packed.shape[1]))).ravel()
+
+
+def first_seen_unique(keys):
+    """
+    numpy.unique, but the unique keys are numbered in order of first appearance like the OrderedDict the
+    export used to build. Returns the position of the first occurrence of every unique key, in that order,
+    and the unique key number of every entry of keys.
+    """
+    if len(keys) == 0:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    order = numpy.argsort(first, kind='stable')
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+
+# first_seen_unique for keys that arrive in chunks, the unique keys seen so far are kept sorted for searchsorted
+class UniqueKeyTable(object):
+
+    def __init__(self):
+        self.keys = None
+        self.ids = numpy.empty(0, dtype=numpy.int64)
 
-    def __hash__(self):
-        # 这里将步骤拆分开来，更易于理解
-        immutable_items = []
-        for k, v in self.items():
-            tuple_v = tuple(v)
-            pair = (k, tuple_v)
-            immutable_items.append(pair)
-        sorted_items = sorted(immutable_items)
-        immutable = tuple(sorted_items)
-        return hash(immutable)
+    def __len__(self):
+        return len(self.ids)
+
+    def insert(self, keys):
+        """Returns the number of every key and the positions of the keys not seen before"""
+        first, rank = first_seen_unique(keys)
+        chunk_keys = keys[first]
+        found = numpy.zeros(len(first), dtype=bool)
+        ids = numpy.empty(len(first), dtype=numpy.int64)
+        if len(self):
+            position = numpy.minimum(numpy.searchsorted(self.keys, chunk_keys), len(self) - 1)
+            found = self.keys[position] == chunk_keys
+            ids[found] = self.ids[position[found]]
+        new = ~found
+        ids[new] = numpy.arange(len(self), len(self) + numpy.count_nonzero(new))
+
+        new_keys = chunk_keys[new]
+        order = numpy.argsort(new_keys)
+        new_keys, new_ids = new_keys[order], ids[new][order]
+        if self.keys is None:
+            self.keys, self.ids = new_keys, new_ids
+        else:
+            position = numpy.searchsorted(self.keys, new_keys)
+            self.keys = numpy.insert(self.keys, position, new_keys)
+            self.ids = numpy.insert(self.ids, position, new_ids)
+        return ids[rank], first[new]
+
+
+def deduplicate_vertices(columns):
+    """
+    Merges identical loops into vertices. Returns the loop every vertex was taken from (in the same order
+    a dict of per loop vertices keyed by their values would produce) and the vertex index of every loop, which is the
+    index buffer when the loops are in polygon order.
+    """
+    if not columns:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+    return first_seen_unique(pack_rows(columns))
+
+
+def unify_tangents(columns, mode='FIRST'):
+    """
+    这里我们把相同POSITION和NORMAL的loop分成一组，每组只使用一个TANGENT
+    这样就能得到每个Position对应的切线，在切线值相同的情况下，就不会产生额外的多余顶点了。
+    FIRST: 使用这个顶点第一次出现的TANGENT作为它的TANGENT，和之前逐loop的字典结果完全一样
+    AVERAGE: 使用这一组TANGENT的平均值（重新归一化）作为TANGENT，第四个分量还是使用第一次出现的值
+    """
+    if "POSITION" not in columns or "NORMAL" not in columns or "TANGENT" not in columns:
+        return
+    first, group = first_seen_unique(pack_rows(collections.OrderedDict(
+        (semantic, columns[semantic]) for semantic in ("POSITION", "NORMAL"))))
+    tangents = numpy.asarray(columns["TANGENT"])
+    unified = tangents[first]
+    if mode == 'AVERAGE':
+        xyz = numpy.zeros((len(first), 3), dtype=numpy.float64)
+        numpy.add.at(xyz, group, tangents[:, :3].astype(numpy.float64))
+        length = numpy.linalg.norm(xyz, axis=1, keepdims=True)
+        # 切线互相抵消的组没办法求平均，保留第一次出现的值
+        numpy.divide(xyz, length, out=xyz, where=length > 0.0)
+        unified = unified.copy()
+        valid = length.ravel() > 0.0
+        unified[valid, :3] = xyz[valid]
+    elif mode != 'FIRST':
+        raise Fatal('Unknown tangent unification mode: %s' % mode)
+    columns["TANGENT"] = unified[group]
+
+
+def top_influences(vertex, group, weight, vertex_count, k, normalize=False, threshold=0.0):
+    """
+    Picks the k strongest vertex groups of every vertex from flat (vertex, group, weight) membership arrays.
+    Returns (vertex_count, k) blend indices and weights, unused slots are 0, plus the number of vertices that
+    had more than k non zero influences. The order within a vertex is the same one sorted(groups,
+    key=weight, reverse=True) gave, ties keep their membership order, which is why this uses a stable sort
+    instead of argpartition: the exported blend indices stay identical to the old export.
+    """
+    vertex = numpy.asarray(vertex, dtype=numpy.int64)
+    group = numpy.asarray(group, dtype=numpy.int64)
+    weight = numpy.asarray(weight, dtype=numpy.float32)
+    if threshold > 0.0:
+        keep = weight >= threshold
+        vertex, group, weight = vertex[keep], group[keep], weight[keep]
+
+    nonzero = numpy.bincount(vertex[weight != 0.0], minlength=vertex_count)
+    overflow = int(numpy.count_nonzero(nonzero > k))
+
+    order = numpy.lexsort((-weight, vertex))
+    vertex, group, weight = vertex[order], group[order], weight[order]
+    counts = numpy.bincount(vertex, minlength=vertex_count)
+    starts = numpy.cumsum(counts) - counts
+    rank = numpy.arange(len(vertex)) - starts[vertex]
+    keep = rank < k
+
+    indices = numpy.zeros((vertex_count, k), dtype=numpy.int64)
+    weights = numpy.zeros((vertex_count, k), dtype=numpy.float32)
+    indices[vertex[keep], rank[keep]] = group[keep]
+    weights[vertex[keep], rank[keep]] = weight[keep]
+
+    if normalize:
+        totals = weights.sum(axis=1, keepdims=True)
+        numpy.divide(weights, totals, out=weights, where=totals > 0.0)
+    return indices, weights, overflow
+
+
+def vgmap_lookup_table(vertex_groups, mapping, size=0):
+    """
+    Turns a 3DMigoto:VGMap into a numpy array indexed by vertex group index, resolving each index the same
+    way the old per vertex lookup did: by vertex group name first, then by index, otherwise unchanged.
+    """
+    lut = numpy.arange(max(size, len(vertex_groups)), dtype=numpy.int64)
+    for x, vertex_group in enumerate(vertex_groups):
+        lut[x] = mapping.get(vertex_group.name, mapping.get(x, x))
+    for x in range(len(vertex_groups), len(lut)):
+        lut[x] = mapping.get(x, x)
+    return lut
+
+
+def parse_vertex_data_columns(text, layout, semantics=None):
+    """
+    Fast parser for the vertex-data section of a frame analysis -vb*.txt dump. Instead of matching every
+    line and converting every field in python, each semantic is collected with a single regular expression
+    scan over the whole section and converted by numpy in one go: int64 for *INT formats and float64 for
+    the rest.
+
+    semantics is an optional whitelist of element names or semantic names (e.g. TEXCOORD matches TEXCOORD1),
+    anything not in it is never converted.
+    """
+    end = text.find('instance-data:')
+    if end != -1:
+        text = text[:end]
+
+    columns = collections.OrderedDict()
+    for elem in layout:
+        if semantics is not None and elem.name not in semantics and elem.SemanticName not in semantics:
+            continue
+        # Not anchored to the start of the line on purpose, a literal prefix lets the regex engine skip ahead
+        # to the candidates, which is several times faster than matching the full line pattern:
+        pattern = re.compile(r'''\]\+\d+ %s: (.*)''' % re.escape(elem.name))
+        fields = pattern.findall(text)
+        if not fields:
+            continue
+        dtype = numpy.int64 if elem.Format.endswith('INT') else numpy.float64
+        data = parse_text_array(','.join(fields), dtype, ',')
+        if len(data) % len(fields):
+            raise Fatal('%s has an inconsistent number of components in the vertex data' % elem.name)
+        columns[elem.name] = data.reshape(len(fields), -1)
+
+    lengths = set(len(data) for data in columns.values())
+    if len(lengths) > 1:
+        raise Fatal('Not every vertex in the vertex data has the same semantics')
+    return columns
 
 
 class VertexBuffer(object):
-    vb_elem_pattern = re.compile(r'''vb\d+\[\d*\]\+\d+ (?P<semantic>[^:]+): (?P<data>.*)$''')
-
+    """
+    Vertex data is stored column wise, one (vertex count, components) numpy array per semantic in
+    self.columns, instead of a python dict per vertex. Code that still wants per vertex dicts can use
+    iter_vertices() or the vertices property, but that is slow and only meant for debugging.
+    """
     # Python gotcha - do not set layout=InputLayout() in the default function
     # parameters, as they would all share the *same* InputLayout since the
     # default values are only evaluated once on file load
-    def __init__(self, f=None, layout=None, load_vertices=True):
-        self.vertices = []
+    # semantics is an optional whitelist for the vertex data of .txt files, see parse_vertex_data_columns
+    def __init__(self, f=None, layout=None, load_vertices=True, semantics=None):
+        self.columns = collections.OrderedDict()
         self.layout = layout and layout or InputLayout()
         self.first = 0
         self.vertex_count = 0
         self.offset = 0
         self.topology = 'trianglelist'
+        # Semantics whose columns still hold the raw UNORM/SNORM integers, see map_vb_bin
+        self.pending_scales = {}
 
         if f is not None:
-            self.parse_vb_txt(f, load_vertices)
+            self.parse_vb_txt(f, load_vertices, semantics)
 
-    def parse_vb_txt(self, f, load_vertices):
+    def parse_vb_txt(self, f, load_vertices, semantics=None):
         for line in map(str.strip, f):
             # print(line)
             if line.startswith('byte offset:'):
@@ -232,83 +480,114 @@ class VertexBuffer(object):
             if line.startswith('vertex-data:'):
                 if not load_vertices:
                     return
-                self.parse_vertex_data(f)
-        assert (len(self.vertices) == self.vertex_count)
+                self.parse_vertex_data(f, semantics)
+        # With a whitelist that excludes everything there is nothing to count
+        assert (not self.columns or len(self) == self.vertex_count)
 
     def parse_vb_bin(self, f):
         f.seek(self.offset)
         # XXX: Should we respect the first/base vertex?
         # f.seek(self.first * self.layout.stride, whence=1)
         self.first = 0
-        while True:
-            vertex = f.read(self.layout.stride)
-            if not vertex:
-                break
-            self.vertices.append(self.layout.decode(vertex))
+        data = f.read()
+        self.columns = self.layout.codec.decode_columns(data, len(data) // self.layout.stride)
         # We intentionally disregard the vertex count when loading from a
         # binary file, as we assume frame analysis might have only dumped a
         # partial buffer to the .txt files (e.g. if this was from a dump where
         # the draw call index count was overridden it may be cut short, or
         # where the .txt files contain only sub-meshes from each draw call and
         # we are loading the .buf file because it contains the entire mesh):
-        self.vertex_count = len(self.vertices)
+        self.vertex_count = len(self)
+
+    def map_vb_bin(self, path, semantics=None, draw_call_only=False):
+        """
+        Like parse_vb_bin, but memory maps the file and only creates numpy views over it starting at the
+        byte offset, nothing is read or copied until the columns are actually used. Semantics outside the
+        optional whitelist get no column at all, and UNORM/SNORM columns stay raw integer views until
+        apply_scales(), so slicing or compacting the vertices first only ever converts the vertices kept.
+        With draw_call_only the first vertex and vertex count from the .txt header are respected, the same
+        as IndexBuffer.map_ib_bin does for the indices, so the vertices match what the .txt file holds.
+        """
+        stride = self.layout.stride
+        data = map_binary_file(path)
+        offset = min(self.offset, len(data))
+        count = (len(data) - offset) // stride
+        if draw_call_only and self.vertex_count:
+            offset = min(offset + self.first * stride, len(data))
+            count = min(self.vertex_count, (len(data) - offset) // stride)
+        self.first = 0
+        codec = self.layout.codec
+        self.columns = codec.decode_columns(data, count, offset, semantics, scale=False)
+        self.pending_scales = dict((semantic, codec.scales[semantic]) for semantic in self.columns
+                                   if codec.scales[semantic] is not None)
+        self.vertex_count = len(self)
+
+    def apply_scales(self):
+        """Converts the UNORM/SNORM columns map_vb_bin left as raw integers to floats"""
+        for semantic, scale in self.pending_scales.items():
+            self.columns[semantic] = self.columns[semantic] / scale
+        self.pending_scales = {}
+
+    def set_columns(self, columns):
+        lengths = set(len(data) for data in columns.values())
+        if len(lengths) > 1:
+            raise Fatal('Vertex buffer columns have different lengths: %s' % sorted(lengths))
+        self.columns = collections.OrderedDict(columns)
+        self.vertex_count = len(self)
 
     def append(self, vertex):
-        self.vertices.append(vertex)
+        # Compatibility only - this copies every column, build the columns in one go with set_columns()
+        for semantic, data in vertex.items():
+            row = numpy.array([data])
+            if semantic in self.columns:
+                self.columns[semantic] = numpy.concatenate((self.columns[semantic], row))
+            else:
+                self.columns[semantic] = row
         self.vertex_count += 1
 
-    def parse_vertex_data(self, f):
-        vertex = {}
-        for line in map(str.strip, f):
-            # print(line)
-            if line.startswith('instance-data:'):
-                break
-
-            match = self.vb_elem_pattern.match(line)
-            if match:
-                vertex[match.group('semantic')] = self.parse_vertex_element(match)
-            elif line == '' and vertex:
-                self.vertices.append(vertex)
-                vertex = {}
-        if vertex:
-            self.vertices.append(vertex)
-
-    def parse_vertex_element(self, match):
-        fields = match.group('data').split(',')
-
-        if self.layout[match.group('semantic')].Format.endswith('INT'):
-            return tuple(map(int, fields))
-
-        return tuple(map(float, fields))
-
-    def remap_blendindices(self, obj, mapping):
-        def lookup_vgmap(x):
-            vgname = obj.vertex_groups[x].name
-            return mapping.get(vgname, mapping.get(x, x))
-
-        for vertex in self.vertices:
-            for semantic in list(vertex):
-                if semantic.startswith('BLENDINDICES'):
-                    vertex['~' + semantic] = vertex[semantic]
-                    vertex[semantic] = tuple(lookup_vgmap(x) for x in vertex[semantic])
-
-    def revert_blendindices_remap(self):
-        # Significantly faster than doing a deep copy
-        for vertex in self.vertices:
-            for semantic in list(vertex):
-                if semantic.startswith('BLENDINDICES'):
-                    vertex[semantic] = vertex['~' + semantic]
-                    del vertex['~' + semantic]
+    def iter_vertices(self):
+        semantics = list(self.columns.keys())
+        for values in zip(*(data.tolist() for data in self.columns.values())):
+            yield dict(zip(semantics, values))
+
+    @property
+    def vertices(self):
+        return list(self.iter_vertices())
+
+    def parse_vertex_data(self, f, semantics=None):
+        self.columns = parse_vertex_data_columns(f.read(), self.layout, semantics)
+
+    def blendindices_size(self):
+        """Size a vgmap lookup table needs to cover every blend index used by this vertex buffer"""
+        return max([int(data.max(initial=0)) + 1 for semantic, data in self.columns.items()
+                    if semantic.startswith('BLENDINDICES')] + [0])
+
+    def blendindices_lookup_table(self, obj, mapping):
+        return vgmap_lookup_table(obj.vertex_groups, mapping, self.blendindices_size())
+
+    def encode(self):
+        return self.layout.codec.encode(self.columns, len(self))
+
+    def encode_blendindices_remap(self, records, lut):
+        """
+        Copy of already encoded records with only the BLENDINDICES fields re-encoded through a vgmap lookup
+        table, every vgmap variant of the same buffer shares the rest of the encoding work.
+        """
+        records = records.copy()
+        for semantic, data in self.columns.items():
+            if semantic.startswith('BLENDINDICES'):
+                self.layout.codec.encode_field(records, semantic, lut[data])
+        return records
 
     def disable_blendweights(self):
-        for vertex in self.vertices:
-            for semantic in list(vertex):
-                if semantic.startswith('BLENDINDICES'):
-                    vertex[semantic] = (0, 0, 0, 0)
+        for semantic in list(self.columns):
+            if semantic.startswith('BLENDINDICES'):
+                self.columns[semantic] = numpy.zeros((len(self), 4), dtype=numpy.int64)
 
-    def write(self, output, operator=None):
-        for vertex in self.vertices:
-            output.write(self.layout.encode(vertex))
+    def write(self, output, operator=None, records=None):
+        if records is None:
+            records = self.encode()
+        output.write(records.tobytes())
 
         msg = 'Wrote %i vertices to %s' % (len(self), output.name)
         if operator:
@@ -317,7 +596,9 @@ class VertexBuffer(object):
             print(msg)
 
     def __len__(self):
-        return len(self.vertices)
+        for data in self.columns.values():
+            return len(data)
+        return 0
 
     def merge(self, other):
         if self.layout != other.layout:
@@ -328,35 +609,106 @@ class VertexBuffer(object):
             # index buffer and chop off unreferenced vertices to save space
             raise Fatal(
                 'Cannot merge multiple vertex buffers - please check for updates of the 3DMigoto import script, or import each buffer separately')
-        self.vertices.extend(other.vertices[self.vertex_count:])
+        if len(other) > len(self):
+            if not self.columns:
+                self.columns = collections.OrderedDict(other.columns)
+            else:
+                for semantic, data in self.columns.items():
+                    self.columns[semantic] = numpy.concatenate((data, other.columns[semantic][len(self):]))
         self.vertex_count = max(self.vertex_count, other.vertex_count)
-        assert (len(self.vertices) == self.vertex_count)
+        assert (len(self) == self.vertex_count)
 
     def wipe_semantic_for_testing(self, semantic, val=0):
         print('WARNING: WIPING %s FOR TESTING PURPOSES!!!' % semantic)
         semantic, _, components = semantic.partition('.')
+        if semantic not in self.columns:
+            return
+        data = self.columns[semantic].copy()
         if components:
             components = [{'x': 0, 'y': 1, 'z': 2, 'w': 3}[c] for c in components]
         else:
             components = range(4)
-        for vertex in self.vertices:
-            for s in list(vertex):
-                if s == semantic:
-                    v = list(vertex[semantic])
-                    for component in components:
-                        if component < len(v):
-                            v[component] = val
-                    vertex[semantic] = v
+        for component in components:
+            if component < data.shape[1]:
+                data[:, component] = val
+        self.columns[semantic] = data
+
+
+def validate_faces(faces, vertex_count):
+    """
+    Checks a triangle list the same way mesh.validate() would, but for the whole index buffer at once:
+    faces with out of range indices, degenerate faces (a vertex used twice) and duplicates of an earlier
+    face with the same vertices are removed. Returns the remaining faces and the number of faces removed
+    for every kind of problem, when nothing was removed the faces are returned unchanged.
+    """
+    faces = numpy.asarray(faces).reshape(-1, 3)
+    signed = faces.astype(numpy.int64)
+    out_of_range = numpy.any((signed < 0) | (signed >= vertex_count), axis=1)
+    degenerate = ~out_of_range & ((signed[:, 0] == signed[:, 1]) | (signed[:, 1] == signed[:, 2]) |
+                                  (signed[:, 0] == signed[:, 2]))
+    valid = ~(out_of_range | degenerate)
+
+    first, _ = first_seen_unique(pack_rows(collections.OrderedDict(faces=numpy.sort(signed[valid], axis=1))))
+    unique = numpy.zeros(numpy.count_nonzero(valid), dtype=bool)
+    unique[first] = True
+    keep = valid.copy()
+    keep[valid] = unique
+
+    problems = collections.OrderedDict((
+        ('out of range', int(numpy.count_nonzero(out_of_range))),
+        ('degenerate', int(numpy.count_nonzero(degenerate))),
+        ('duplicate', len(unique) - len(first)),
+    ))
+    if keep.all():
+        return faces, problems
+    return faces[keep], problems
+
+
+def validate_vertex_values(columns, semantics=('POSITION', 'NORMAL')):
+    """
+    The vertex part of mesh.validate(): non finite (NaN/inf) components of the given semantics are set to 0.
+    Columns are replaced rather than changed in place, as they may be read only views of a mapped file.
+    Returns the number of vertices fixed for every semantic.
+    """
+    problems = collections.OrderedDict()
+    for semantic in semantics:
+        data = columns.get(semantic)
+        if data is None or data.dtype.kind != 'f':
+            continue
+        finite = numpy.isfinite(data)
+        problems[semantic] = int(numpy.count_nonzero(~finite.all(axis=1)))
+        if problems[semantic]:
+            columns[semantic] = numpy.where(finite, data, 0.0).astype(data.dtype)
+    return problems
+
+
+def compact_vertex_indices(faces):
+    """
+    Renumbers the vertices referenced by faces to 0..n-1, keeping their relative order. Returns the original
+    index of every remaining vertex and the remapped faces.
+    """
+    used, inverse = numpy.unique(numpy.asarray(faces), return_inverse=True)
+    return used.astype(numpy.int64), inverse.reshape(-1, 3)
 
 
 class IndexBuffer(object):
+    """
+    Faces are stored as an (N, 3) numpy integer array. append() is still supported for building a buffer
+    face by face, the faces are collected and concatenated into the array the next time it is accessed.
+
+    An index buffer split into several draw calls has one (first index, index count, base vertex, vertex
+    count) tuple per draw call in chunks. In memory the faces always index the whole vertex buffer, in the
+    files the indices of every chunk are relative to its base vertex so they fit in R16_UINT.
+    """
     def __init__(self, *args, load_indices=True):
-        self.faces = []
+        self._faces = numpy.empty((0, 3), dtype=numpy.int64)
+        self._pending_faces = []
         self.first = 0
         self.index_count = 0
         self.format = 'DXGI_FORMAT_UNKNOWN'
         self.offset = 0
         self.topology = 'trianglelist'
+        self.chunks = []
 
         if isinstance(args[0], io.IOBase):
             assert (len(args) == 1)
@@ -364,10 +716,21 @@ class IndexBuffer(object):
         else:
             self.format, = args
 
-        self.encoder, self.decoder = EncoderDecoder(self.format)
+    @property
+    def faces(self):
+        if self._pending_faces:
+            pending = numpy.array(self._pending_faces, dtype=numpy.int64).reshape(-1, 3)
+            self._faces = numpy.concatenate((self._faces, pending))
+            self._pending_faces = []
+        return self._faces
+
+    @faces.setter
+    def faces(self, faces):
+        self._faces = numpy.asarray(faces).reshape(-1, 3)
+        self._pending_faces = []
 
     def append(self, face):
-        self.faces.append(face)
+        self._pending_faces.append(face)
         self.index_count += len(face)
 
     def parse_ib_txt(self, f, load_indices):
@@ -384,6 +747,9 @@ class IndexBuffer(object):
                     raise Fatal('"%s" is not yet supported' % line)
             elif line.startswith('format:'):
                 self.format = line[8:]
+            elif line.startswith('draw['):
+                # draw[0]: first index: 0, index count: 3, base vertex: 0, vertex count: 3
+                self.chunks.append(tuple(int(x.split(':')[1]) for x in line.split(': ', 1)[1].split(',')))
             elif line == '':
                 if not load_indices:
                     return
@@ -392,21 +758,16 @@ class IndexBuffer(object):
 
     def parse_ib_bin(self, f):
         f.seek(self.offset)
-        stride = format_size(self.format)
+        dtype = dxgi_format(self.format).numpy_dtype()
         # XXX: Should we respect the first index?
         # f.seek(self.first * stride, whence=1)
         self.first = 0
 
-        face = []
-        while True:
-            index = f.read(stride)
-            if not index:
-                break
-            face.append(*self.decoder(index))
-            if len(face) == 3:
-                self.faces.append(tuple(face))
-                face = []
-        assert (len(face) == 0)
+        data = f.read()
+        count = len(data) // dtype.itemsize
+        assert (count % 3 == 0)
+        self.faces = numpy.frombuffer(data, dtype=dtype, count=count)
+        self.apply_chunk_base_vertices()
 
         # We intentionally disregard the index count when loading from a
         # binary file, as we assume frame analysis might have only dumped a
@@ -416,11 +777,42 @@ class IndexBuffer(object):
         # we are loading the .buf file because it contains the entire mesh):
         self.index_count = len(self.faces) * 3
 
+    def map_ib_bin(self, path, draw_call_only=False):
+        """
+        Like parse_ib_bin, but the faces are a numpy view over a memory mapped file.
+        With draw_call_only the first index and index count from the .txt header are respected, for when
+        the header is known to be complete (a hashed frame analysis dump) and the .buf holds the index
+        buffer shared by several draw calls.
+        """
+        dtype = dxgi_format(self.format).numpy_dtype()
+        data = map_binary_file(path)
+        offset = min(self.offset, len(data))
+        count = (len(data) - offset) // dtype.itemsize
+        if draw_call_only and self.index_count:
+            offset = min(offset + self.first * dtype.itemsize, len(data))
+            count = min(self.index_count, (len(data) - offset) // dtype.itemsize)
+        self.first = 0
+        assert (count % 3 == 0)
+        self.faces = numpy.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        self.index_count = len(self.faces) * 3
+        self.apply_chunk_base_vertices()
+
     def parse_index_data(self, f):
-        for line in map(str.strip, f):
-            face = tuple(map(int, line.split()))
-            assert (len(face) == 3)
-            self.faces.append(face)
+        indices = parse_text_array(f.read(), numpy.int64, ' ')
+        assert (len(indices) % 3 == 0)
+        self.faces = indices
+
+    def chunk_base_vertices(self):
+        """Base vertex of every index as an (N, 3) array, zero for an index buffer without chunks"""
+        base = numpy.zeros(len(self), dtype=numpy.int64)
+        for first, count, base_vertex, vertex_count in self.chunks:
+            base[first:first + count] = base_vertex
+        return base.reshape(-1, 3)
+
+    def apply_chunk_base_vertices(self):
+        """Turns chunk relative indices loaded from a file back into indices into the whole vertex buffer"""
+        if self.chunks:
+            self.faces = self.faces.astype(numpy.int64) + self.chunk_base_vertices()
 
     def merge(self, other):
         if self.format != other.format:
@@ -428,11 +820,14 @@ class IndexBuffer(object):
                 'Index buffers have different formats - ensure you are only trying to merge the same index buffer split across multiple draw calls')
         self.first = min(self.first, other.first)
         self.index_count += other.index_count
-        self.faces.extend(other.faces)
+        self.faces = numpy.concatenate((self.faces, other.faces))
 
     def write(self, output, operator=None):
-        for face in self.faces:
-            output.write(self.encoder(face))
+        dtype = dxgi_format(self.format).numpy_dtype()
+        faces = self.faces
+        if self.chunks:
+            faces = faces - self.chunk_base_vertices()
+        output.write(faces.astype(dtype).tobytes())
 
         msg = 'Wrote %i indices to %s' % (len(self), output.name)
         if operator:
@@ -442,4 +837,3 @@ class IndexBuffer(object):
 
     def __len__(self):
         return len(self.faces) * 3
-
@@ -4,6 +4,8 @@ from glob import glob
 
 import os.path
 import itertools
+import time
+import numpy
 import bpy
 
 from bpy_extras.io_utils import unpack_list, ImportHelper, axis_conversion
@@ -11,7 +13,7 @@ from bpy.props import BoolProperty, StringProperty, CollectionProperty
 from bpy_extras.io_utils import orientation_helper
 
 
-def load_3dmigoto_mesh_bin(operator, vb_paths, ib_paths):
+def load_3dmigoto_mesh_bin(operator, vb_paths, ib_paths, draw_call_only=False):
     if len(vb_paths) != 1 or len(ib_paths) > 1:
         raise Fatal('Cannot merge meshes loaded from binary files')
 
@@ -20,28 +22,77 @@ def load_3dmigoto_mesh_bin(operator, vb_paths, ib_paths):
     vb_bin_path, vb_txt_path = vb_paths[0]
     ib_bin_path, ib_txt_path = ib_paths[0]
 
-    vb = VertexBuffer(open(vb_txt_path, 'r'), load_vertices=False)
-    vb.parse_vb_bin(open(vb_bin_path, 'rb'))
+    # The binary files are memory mapped, so only the parts that are actually used get read, and the data
+    # is only copied once it is handed over to Blender:
+    start = time.perf_counter()
+    with open(vb_txt_path, 'r') as f:
+        vb = VertexBuffer(f, load_vertices=False)
+    vb.map_vb_bin(vb_bin_path, import_semantics, draw_call_only)
+    report_load_time(operator, vb_bin_path, 'binary', start)
 
     ib = None
     if ib_paths:
-        ib = IndexBuffer(open(ib_txt_path, 'r'), load_indices=False)
-        ib.parse_ib_bin(open(ib_bin_path, 'rb'))
+        start = time.perf_counter()
+        with open(ib_txt_path, 'r') as f:
+            ib = IndexBuffer(f, load_indices=False)
+        ib.map_ib_bin(ib_bin_path, draw_call_only)
+        report_load_time(operator, ib_bin_path, 'binary', start)
 
     return vb, ib, os.path.basename(vb_bin_path)
 
 
+class ImportTimings(object):
+    """Wall clock time of every stage of an import, printed as one breakdown line at the end"""
+
+    def __init__(self):
+        self.stages = []
+        self.last = time.time()
+        self.start = self.last
+
+    def resume(self):
+        """Leaves the time since the last stage (e.g. waiting for other meshes to decode) out of the breakdown"""
+        now = time.time()
+        self.start += now - self.last
+        self.last = now
+
+    def stage(self, name):
+        now = time.time()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    def report(self, name):
+        print('NOTICE: Imported %s in %.3fs: %s' % (name, self.last - self.start,
+                                                   ', '.join('%s %.3fs' % stage for stage in self.stages)))
+
+
+def report_load_time(operator, path, method, start):
+    operator.report({'INFO'}, 'Loaded %s (%s) in %.3fs' % (os.path.basename(path), method, time.perf_counter() - start))
+
+
+# Semantics import_vertices actually uses, anything else (e.g. TANGENT and BINORMAL, which are recalculated on
+# export) is never converted when parsing the vertex data of .txt dumps or mapping the .buf files:
+import_semantics = ('POSITION', 'NORMAL', 'COLOR', 'TEXCOORD', 'BLENDINDICES', 'BLENDWEIGHT')
+
+
 def load_3dmigoto_mesh(operator, paths):
-    vb_paths, ib_paths, use_bin = zip(*paths)
+    # use_bin: load the .buf/.vb/.ib files with the .txt/.fmt only used as a format reference
+    # draw_call_only: the .txt header is complete, only the draw call it describes is taken from the binary
+    vb_paths, ib_paths, use_bin, draw_call_only = zip(*paths)
 
     if use_bin[0]:
-        return load_3dmigoto_mesh_bin(operator, vb_paths, ib_paths)
+        return load_3dmigoto_mesh_bin(operator, vb_paths, ib_paths, draw_call_only[0])
 
-    vb = VertexBuffer(open(vb_paths[0], 'r'))
+    start = time.perf_counter()
+    with open(vb_paths[0], 'r') as f:
+        vb = VertexBuffer(f, semantics=import_semantics)
+    report_load_time(operator, vb_paths[0], 'text', start)
     # Merge additional vertex buffers for meshes split over multiple draw calls:
     for vb_path in vb_paths[1:]:
-        tmp = VertexBuffer(open(vb_path, 'r'))
+        start = time.perf_counter()
+        with open(vb_path, 'r') as f:
+            tmp = VertexBuffer(f, semantics=import_semantics)
         vb.merge(tmp)
+        report_load_time(operator, vb_path, 'text', start)
 
     # For quickly testing how importent any unsupported semantics may be:
     # vb.wipe_semantic_for_testing('POSITION.w', 1.0)
@@ -53,15 +104,28 @@ def load_3dmigoto_mesh(operator, paths):
 
     ib = None
     if ib_paths:
-        ib = IndexBuffer(open(ib_paths[0], 'r'))
+        start = time.perf_counter()
+        with open(ib_paths[0], 'r') as f:
+            ib = IndexBuffer(f)
+        report_load_time(operator, ib_paths[0], 'text', start)
         # Merge additional vertex buffers for meshes split over multiple draw calls:
         for ib_path in ib_paths[1:]:
-            tmp = IndexBuffer(open(ib_path, 'r'))
+            start = time.perf_counter()
+            with open(ib_path, 'r') as f:
+                tmp = IndexBuffer(f)
             ib.merge(tmp)
+            report_load_time(operator, ib_path, 'text', start)
 
     return vb, ib, os.path.basename(vb_paths[0])
 
 
+def loop_vertex_indices(mesh):
+    """vertex_index of every loop, used to expand per vertex columns to the loop domain with one fancy index"""
+    indices = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+    mesh.loops.foreach_get('vertex_index', indices)
+    return indices
+
+
 def import_normals_step1(mesh, data):
     # Nico:
     # Blender不支持4D normal，而UE4 Normal的的第四个分量一般情况下是1，可以忽略后导入
@@ -71,63 +135,92 @@ def import_normals_step1(mesh, data):
     # if len(data[0]) == 4:
         # if [x[3] for x in data] != [0.0] * len(data):
         #     raise Fatal('Normals are 4D')
-    normals = [(x[0], x[1], x[2]) for x in data]
-
-    # To make sure the normals don't get lost by Blender's edit mode,
-    # or mesh.update() we need to set custom normals in the loops, not
-    # vertices.
-    #
-    # For testing, to make sure our normals are preserved let's use
-    # garbage ones:
-    # import random
-    # normals = [(random.random() * 2 - 1,random.random() * 2 - 1,random.random() * 2 - 1) for x in normals]
-    #
+
     # Comment from other import scripts:
     # Note: we store 'temp' normals in loops, since validate() may alter final mesh,
     #       we can only set custom lnors *after* calling it.
-
-    # TODO This can't use in BlenderV4.1  see:
-    # https://developer.blender.org/docs/release_notes/4.1/python_api/#mesh
-    mesh.create_normals_split()
-    for l in mesh.loops:
-        # TODO mesh loop.normal is read only in 4.1!
-        l.normal[:] = normals[l.vertex_index]
+    # Every loop of a vertex gets the same normal, so rather than storing them
+    # in the loops (which needs create_normals_split, gone in Blender 4.1) the
+    # per vertex normals are kept and set after validate() in step 2:
+    return numpy.ascontiguousarray(data[:, :3], dtype=numpy.float32)
 
 
-def import_normals_step2(mesh):
-    # Taken from import_obj/import_fbx
-    clnors = array('f', [0.0] * (len(mesh.loops) * 3))
-    mesh.loops.foreach_get("normal", clnors)
-    mesh.polygons.foreach_set("use_smooth", [True] * len(mesh.polygons))
-    mesh.normals_split_custom_set(tuple(zip(*(iter(clnors),) * 3)))
+def import_normals_step2(mesh, normals):
+    # Sets the custom normals per vertex, validate() never adds or removes
+    # vertices so they still line up, whatever it did to the loops:
+    use_smooth = numpy.ones(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_set("use_smooth", use_smooth)
+    mesh.normals_split_custom_set_from_vertices(normals)
 
 
 def import_vertex_groups(mesh, obj, blend_indices, blend_weights):
     assert (len(blend_indices) == len(blend_weights))
     if blend_indices:
+        # Flatten every (vertex, group, weight) influence in the same order the
+        # old per vertex loop visited them: vertex, then semantic index, then
+        # component. Only as many components as both columns have are used,
+        # the same as zip() did:
+        vertex_count = len(mesh.vertices)
+        indices = []
+        weights = []
+        for semantic_index in sorted(blend_indices.keys()):
+            index_data = numpy.asarray(blend_indices[semantic_index]).reshape(vertex_count, -1)
+            weight_data = numpy.asarray(blend_weights[semantic_index]).reshape(vertex_count, -1)
+            components = min(index_data.shape[1], weight_data.shape[1])
+            indices.append(index_data[:, :components])
+            weights.append(weight_data[:, :components])
+        indices = numpy.concatenate(indices, axis=1).astype(numpy.int64)
+        weights = numpy.concatenate(weights, axis=1)
+
         # We will need to make sure we re-export the same blend indices later -
         # that they haven't been renumbered. Not positive whether it is better
         # to use the vertex group index, vertex group name or attach some extra
         # data. Make sure the indices and names match:
-        num_vertex_groups = max(itertools.chain(*itertools.chain(*blend_indices.values()))) + 1
+        num_vertex_groups = int(numpy.concatenate([numpy.asarray(x).ravel() for x in blend_indices.values()]).max()) + 1
         for i in range(num_vertex_groups):
             obj.vertex_groups.new(name=str(i))
-        for vertex in mesh.vertices:
-            for semantic_index in sorted(blend_indices.keys()):
-                for i, w in zip(blend_indices[semantic_index][vertex.index],
-                                blend_weights[semantic_index][vertex.index]):
-                    if w == 0.0:
-                        continue
-                    obj.vertex_groups[i].add((vertex.index,), w, 'REPLACE')
+
+        vertex = numpy.repeat(numpy.arange(vertex_count), indices.shape[1])
+        group = indices.ravel()
+        weight = weights.ravel()
+        keep = weight != 0.0
+        vertex, group, weight = vertex[keep], group[keep], weight[keep]
+
+        # The old code added every influence with REPLACE, so when a vertex
+        # lists the same group more than once the last weight wins:
+        _, last = numpy.unique((group * vertex_count + vertex)[::-1], return_index=True)
+        last = len(vertex) - 1 - last
+        vertex, group, weight = vertex[last], group[last], weight[last]
+
+        # 按骨骼分组，同一个骨骼里权重相同的顶点只需要调用一次add()
+        order = numpy.lexsort((vertex, weight, group))
+        vertex, group, weight = vertex[order], group[order], weight[order]
+        group_starts = numpy.flatnonzero(numpy.diff(group, prepend=-1))
+        group_ends = numpy.append(group_starts[1:], len(group))
+        total_start = time.time()
+        add_calls = 0
+        for start, end in zip(group_starts.tolist(), group_ends.tolist()):
+            group_start = time.time()
+            vertex_group = obj.vertex_groups[int(group[start])]
+            weight_starts = start + numpy.flatnonzero(numpy.diff(weight[start:end], prepend=numpy.nan))
+            weight_ends = numpy.append(weight_starts[1:], end)
+            for weight_start, weight_end in zip(weight_starts.tolist(), weight_ends.tolist()):
+                vertex_group.add(vertex[weight_start:weight_end].tolist(), float(weight[weight_start]), 'REPLACE')
+            add_calls += len(weight_starts)
+            print('NOTICE: Vertex group %s: %i vertices, %i distinct weights, %.3fs'
+                  % (vertex_group.name, end - start, len(weight_starts), time.time() - group_start))
+        print('NOTICE: Imported %i vertex group influences with %i add() calls in %.3fs'
+              % (len(vertex), add_calls, time.time() - total_start))
 
 
 def import_uv_layers(mesh, obj, texcoords, flip_texcoord_v):
+    loop_vertex_index = loop_vertex_indices(mesh)
     for (texcoord, data) in sorted(texcoords.items()):
         # TEXCOORDS can have up to four components, but UVs can only have two
         # dimensions. Not positive of the best way to handle this in general,
         # but for now I'm thinking that splitting the TEXCOORD into two sets of
         # UV coordinates might work:
-        dim = len(data[0])
+        dim = data.shape[1]
         if dim == 4:
             components_list = ('xy', 'zw')
         elif dim == 2:
@@ -159,17 +252,13 @@ def import_uv_layers(mesh, obj, texcoords, flip_texcoord_v):
             # Can't find an easy way to flip the display of V in Blender, so
             # add an option to flip it on import & export:
             if flip_texcoord_v:
-                flip_uv = lambda uv: (uv[0], 1.0 - uv[1])
                 # Record that V was flipped, so we know to undo it when exporting:
                 obj['3DMigoto:' + uv_name] = {'flip_v': True}
-            else:
-                flip_uv = lambda uv: uv
 
-            # TODO WTF? why merge them in one line, too hard to understand.
-            uvs = [[d[cmap[c]] for c in components] for d in data]
-
-            for l in mesh.loops:
-                blender_uvs.data[l.index].uv = flip_uv(uvs[l.vertex_index])
+            uvs = data[:, [cmap[c] for c in components]][loop_vertex_index].astype(numpy.float64)
+            if flip_texcoord_v:
+                uvs[:, 1] = 1.0 - uvs[:, 1]
+            blender_uvs.data.foreach_set('uv', numpy.ascontiguousarray(uvs, dtype=numpy.float32).ravel())
 
 
 # VertexLayer的设计应该被去除
@@ -209,17 +298,19 @@ def import_uv_layers(mesh, obj, texcoords, flip_texcoord_v):
 
 
 def import_faces_from_ib(mesh, ib):
-    mesh.loops.add(len(ib.faces) * 3)
-    mesh.polygons.add(len(ib.faces))
-    mesh.loops.foreach_set('vertex_index', unpack_list(ib.faces))
-    mesh.polygons.foreach_set('loop_start', [x * 3 for x in range(len(ib.faces))])
-    mesh.polygons.foreach_set('loop_total', [3] * len(ib.faces))
+    faces = ib.faces
+    mesh.loops.add(len(faces) * 3)
+    mesh.polygons.add(len(faces))
+    # foreach_set can only take the buffer directly when the dtype matches the C type of the property
+    mesh.loops.foreach_set('vertex_index', numpy.ascontiguousarray(faces, dtype=numpy.int32).ravel())
+    mesh.polygons.foreach_set('loop_start', numpy.arange(0, len(faces) * 3, 3, dtype=numpy.int32))
+    mesh.polygons.foreach_set('loop_total', numpy.full(len(faces), 3, dtype=numpy.int32))
 
 
 # Nico: 这玩意基本上用不到吧，没有IB的情况下要怎么做到自动生成顶点索引呢？这样生成出来真的和游戏里替换所需要的格式一样吗？
 def import_faces_from_vb(mesh, vb):
     # Only lightly tested
-    num_faces = len(vb.vertices) // 3
+    num_faces = len(vb) // 3
     mesh.loops.add(num_faces * 3)
     mesh.polygons.add(num_faces)
     mesh.loops.foreach_set('vertex_index', [x for x in range(num_faces * 3)])
@@ -227,15 +318,22 @@ def import_faces_from_vb(mesh, vb):
     mesh.polygons.foreach_set('loop_total', [3] * num_faces)
 
 
+def loop_colors(data, loop_vertex_index):
+    """Per vertex color columns expanded to the loops and padded with 0 to the channels of a color layer"""
+    colors = numpy.zeros((len(loop_vertex_index), vertex_color_layer_channels), dtype=numpy.float32)
+    colors[:, :data.shape[1]] = data[loop_vertex_index]
+    return colors.ravel()
+
+
 def import_vertices(mesh, vb):
-    mesh.vertices.add(len(vb.vertices))
+    mesh.vertices.add(len(vb))
 
     seen_offsets = set()
     blend_indices = {}
     blend_weights = {}
     texcoords = {}
     vertex_layers = {}
-    use_normals = False
+    normals = None
 
     for elem in vb.layout:
         if elem.InputSlotClass != 'per-vertex':
@@ -248,11 +346,12 @@ def import_vertices(mesh, vb):
             continue
         seen_offsets.add((elem.InputSlot, elem.AlignedByteOffset))
 
-        data = tuple(x[elem.name] for x in vb.vertices)
+        # None for semantics that were left out of the parse by import_semantics
+        data = vb.columns.get(elem.name)
         if elem.name == 'POSITION':
             # Ensure positions are 3-dimensional:
-            if len(data[0]) == 4:
-                if ([x[3] for x in data] != [1.0] * len(data)):
+            if data.shape[1] == 4:
+                if not numpy.all(data[:, 3] == 1.0):
                     # XXX: Leaving this fatal error in for now, as the meshes
                     # it triggers on in DOA6 (skirts) lie about almost every
                     # semantic and we cannot import them with this version of
@@ -269,28 +368,24 @@ def import_vertices(mesh, vb):
                     # W coordinate must be preserved in these cases.
                     # print('Positions are 4D, storing W coordinate in POSITION.w vertex layer')
                     # vertex_layers['POSITION.w'] = [[x[3]] for x in data]
-            positions = [(x[0], x[1], x[2]) for x in data]
-            mesh.vertices.foreach_set('co', unpack_list(positions))
+            mesh.vertices.foreach_set('co', numpy.ascontiguousarray(data[:, :3], dtype=numpy.float32).ravel())
         elif elem.name.startswith('COLOR'):
-            if len(data[0]) <= 3 or vertex_color_layer_channels == 4:
+            if data.shape[1] <= 3 or vertex_color_layer_channels == 4:
                 # Either a monochrome/RGB layer, or Blender 2.80 which uses 4
                 # channel layers
                 mesh.vertex_colors.new(name=elem.name)
                 color_layer = mesh.vertex_colors[elem.name].data
-                c = vertex_color_layer_channels
-                for l in mesh.loops:
-                    color_layer[l.index].color = list(data[l.vertex_index]) + [0] * (c - len(data[l.vertex_index]))
+                color_layer.foreach_set('color', loop_colors(data, loop_vertex_indices(mesh)))
             else:
                 mesh.vertex_colors.new(name=elem.name + '.RGB')
                 mesh.vertex_colors.new(name=elem.name + '.A')
                 color_layer = mesh.vertex_colors[elem.name + '.RGB'].data
                 alpha_layer = mesh.vertex_colors[elem.name + '.A'].data
-                for l in mesh.loops:
-                    color_layer[l.index].color = data[l.vertex_index][:3]
-                    alpha_layer[l.index].color = [data[l.vertex_index][3], 0, 0]
+                loop_vertex_index = loop_vertex_indices(mesh)
+                color_layer.foreach_set('color', loop_colors(data[:, :3], loop_vertex_index))
+                alpha_layer.foreach_set('color', loop_colors(data[:, 3:4], loop_vertex_index))
         elif elem.name == 'NORMAL':
-            use_normals = True
-            import_normals_step1(mesh, data)
+            normals = import_normals_step1(mesh, data)
         elif elem.name in ('TANGENT', 'BINORMAL'):
             #    # XXX: loops.tangent is read only. Not positive how to handle
             #    # this, or if we should just calculate it when re-exporting.
@@ -305,10 +400,12 @@ def import_vertices(mesh, vb):
         elif elem.name.startswith('TEXCOORD') and elem.is_float():
             texcoords[elem.SemanticIndex] = data
         else:
+            if data is None:
+                continue
             print('NOTICE: Storing unhandled semantic %s %s as vertex layer' % (elem.name, elem.Format))
             vertex_layers[elem.name] = data
 
-    return (blend_indices, blend_weights, texcoords, vertex_layers, use_normals)
+    return (blend_indices, blend_weights, texcoords, vertex_layers, normals)
 
 
 def import_3dmigoto(operator, context, paths, **kwargs):
@@ -389,8 +486,107 @@ def find_texture(texture_prefix, texture_suffix, directory):
     return None
 
 
-def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_forward='-Z', axis_up='Y'):
+class DecodedMesh(object):
+    """The buffers of one mesh after decode_3dmigoto_mesh, ready to be turned into Blender data by build_3dmigoto_mesh"""
+
+    def __init__(self, vb, ib, name, timings):
+        self.vb = vb
+        self.ib = ib
+        self.name = name
+        self.timings = timings
+        self.trusted = False
+        self.vertex_remap = None
+        self.original_vertex_count = len(vb)
+
+
+class DeferredReports(object):
+    """
+    Stands in for the operator while decoding off the main thread, operator.report() must only be called
+    from Blender's main thread. The collected reports are passed on with replay().
+    """
+
+    def __init__(self):
+        self.reports = []
+
+    def report(self, type, message):
+        self.reports.append((type, message))
+
+    def replay(self, operator):
+        for type, message in self.reports:
+            operator.report(type, message)
+        self.reports = []
+
+
+def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_forward='-Z', axis_up='Y',
+                          compact_vertices=False):
+    decoded = decode_3dmigoto_mesh(operator, paths, compact_vertices)
+    return build_3dmigoto_mesh(operator, context, decoded, os.path.dirname(paths[0][0][0]), flip_texcoord_v,
+                               axis_forward, axis_up)
+
+
+def decode_3dmigoto_mesh(operator, paths, compact_vertices=False, materialize=False):
+    """
+    The part of the import that doesn't touch bpy: loading and decoding the buffers, validating the index
+    buffer and removing unused vertices. Can run on a worker thread when operator is a DeferredReports.
+    With materialize the arrays are copied out of the memory mapped files, so all the reading is done here.
+    """
+    timings = ImportTimings()
     vb, ib, name = load_3dmigoto_mesh(operator, paths)
+    timings.stage('load')
+    decoded = DecodedMesh(vb, ib, name, timings)
+
+    # 先用numpy检查IB，把mesh.validate()会删除的面提前去掉，这样IB没问题时就可以跳过很慢的validate()
+    decoded.trusted = ib is not None
+    if ib is not None:
+        ib.faces, problems = validate_faces(ib.faces, len(vb))
+        for problem, count in problems.items():
+            if count:
+                operator.report({'WARNING'}, 'Removed %i faces with %s indices from %s' % (count, problem, name))
+        timings.stage('validate IB')
+
+    # .buf文件经常包含多个DrawCall共用的整个VB，这里只保留当前IB用到的顶点，并记录原本的顶点编号用于导出时还原
+    if compact_vertices and ib is not None:
+        used, faces = compact_vertex_indices(ib.faces)
+        if len(used) < len(vb):
+            decoded.vertex_remap = used
+            ib.faces = faces
+            vb.set_columns(collections.OrderedDict((semantic, data[used]) for semantic, data in vb.columns.items()))
+            operator.report({'INFO'}, 'Removed %i vertices the index buffer never uses, %i of %i left'
+                            % (decoded.original_vertex_count - len(used), len(used), decoded.original_vertex_count))
+        timings.stage('compact')
+
+    # 只转换留下来的顶点，UNORM/SNORM的列在这之前都还是.buf文件上的视图
+    vb.apply_scales()
+
+    # validate()还会把NaN/inf的坐标改成0，.buf里没有用到的部分经常会有这种值，跳过validate()时这里要做同样的处理
+    for semantic, count in validate_vertex_values(vb.columns).items():
+        if count:
+            operator.report({'WARNING'}, 'Set non finite %s values of %i vertices to 0 in %s' % (semantic, count, name))
+    if materialize:
+        vb.set_columns(collections.OrderedDict((semantic, numpy.array(data)) for semantic, data in vb.columns.items()))
+        if ib is not None:
+            ib.faces = numpy.array(ib.faces)
+    timings.stage('decode')
+
+    return decoded
+
+
+def decode_3dmigoto_mesh_deferred(paths, compact_vertices=False):
+    """
+    decode_3dmigoto_mesh for a worker thread: the arrays are materialized and the reports collected.
+    Returns (DecodedMesh or None, DeferredReports, Fatal or None).
+    """
+    reports = DeferredReports()
+    try:
+        return decode_3dmigoto_mesh(reports, paths, compact_vertices, materialize=True), reports, None
+    except Fatal as e:
+        return None, reports, e
+
+
+def build_3dmigoto_mesh(operator, context, decoded, directory, flip_texcoord_v=True, axis_forward='-Z', axis_up='Y'):
+    """Creates the Blender object from a DecodedMesh, must run on Blender's main thread"""
+    vb, ib, name, timings = decoded.vb, decoded.ib, decoded.name, decoded.timings
+    timings.resume()
 
     mesh = bpy.data.meshes.new(name)
     obj = bpy.data.objects.new(mesh.name, mesh)
@@ -403,6 +599,9 @@ def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_f
     obj['3DMigoto:VBLayout'] = vb.layout.serialise()
     obj['3DMigoto:VBStride'] = vb.layout.stride
     obj['3DMigoto:FirstVertex'] = vb.first
+    if decoded.vertex_remap is not None:
+        obj['3DMigoto:VertexRemap'] = decoded.vertex_remap.tolist()
+        obj['3DMigoto:OriginalVertexCount'] = decoded.original_vertex_count
 
     # 这里我们不像GIMI一样在导入的时候就把Format变成R32_UINT，我们只在导出的时候改变格式
     if ib is not None:
@@ -412,24 +611,36 @@ def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_f
         obj['3DMigoto:FirstIndex'] = ib.first
     else:
         import_faces_from_vb(mesh, vb)
+    timings.stage('faces')
 
-    (blend_indices, blend_weights, texcoords, vertex_layers, use_normals) = import_vertices(mesh, vb)
+    (blend_indices, blend_weights, texcoords, vertex_layers, normals) = import_vertices(mesh, vb)
+    timings.stage('vertices')
 
     import_uv_layers(mesh, obj, texcoords, flip_texcoord_v)
+    timings.stage('uv layers')
 
     import_vertex_groups(mesh, obj, blend_indices, blend_weights)
+    timings.stage('vertex groups')
 
-    # Validate closes the loops so they don't disappear after edit mode and probably other important things:
-    mesh.validate(verbose=False, clean_customdata=False)  # *Very* important to not remove lnors here!
-    # 这里的lnors可能指的是mesh.loop里的normal？
-    # Not actually sure update is necessary. It seems to update the vertex normals, not sure what else:
-    mesh.update()
+    if decoded.trusted:
+        # The index buffer passed validate_faces and the vertices
+        # validate_vertex_values, so the only thing validate() would still do
+        # is build the edges and close the loops, which update() does as well:
+        mesh.update(calc_edges=True)
+    else:
+        # Validate closes the loops so they don't disappear after edit mode and probably other important things:
+        mesh.validate(verbose=False, clean_customdata=False)  # *Very* important to not remove lnors here!
+        # 这里的lnors可能指的是mesh.loop里的normal？
+        # Not actually sure update is necessary. It seems to update the vertex normals, not sure what else:
+        mesh.update()
+    timings.stage('update' if decoded.trusted else 'validate')
 
     # Must be done after validate step:
-    if use_normals:
-        import_normals_step2(mesh)
+    if normals is not None:
+        import_normals_step2(mesh, normals)
     else:
         mesh.calc_normals()
+    timings.stage('normals')
 
     link_object_to_scene(context, obj)
     obj.select_set(True)
@@ -437,21 +648,7 @@ def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_f
 
     operator.report({'INFO'}, "Import Into 3Dmigoto")
 
-    import bmesh
-    # 创建 BMesh 副本
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
-    
-
-    # 删除松散点 delete loose before get this
-    # bm.verts.ensure_lookup_table()
-    # for v in bm.verts:
-    #     if not v.link_faces:
-    #         bm.verts.remove(v)
-
-    # 将 BMesh 更新回原始网格
-    bm.to_mesh(mesh)
-    bm.free()
+    # 删除松散点的功能见上面的compact_vertices
 
     # 设置导入时的顶点数和索引数，用于插件右键对比是否和原本顶点数量一致
     obj['3DMigoto:OriginalVertexNumber'] = len(mesh.vertices)
@@ -461,7 +658,9 @@ def import_3dmigoto_vb_ib(operator, context, paths, flip_texcoord_v=True, axis_f
     # Nico: 下面是由rayvy提议的添加贴图自动导入支持，需要大量测试如何以优雅的方式和MMT结合在一起
     mesh_prefix: str = str(mesh.name).split(".")[0]
     # operator.report({'INFO'}, mesh_prefix)
-    create_material_with_texture(obj, mesh_prefix, os.path.dirname(paths[0][0][0]))
+    create_material_with_texture(obj, mesh_prefix, directory)
+    timings.stage('material')
+    timings.report(name)
     return obj
 
 
@@ -502,6 +701,18 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
         default=True,
     ) # type: ignore
 
+    compact_vertices: BoolProperty(
+        name="Remove unused vertices",
+        description="Only import the vertices the index buffer uses, the original vertex numbers are stored on the object so the export can restore them",
+        default=False,
+    ) # type: ignore
+
+    prefer_buf: BoolProperty(
+        name="Prefer .buf files",
+        description="Only read the header of the .txt files and take the vertex and index data from the matching .buf files, which is much faster. Falls back to the .txt files when there is no .buf",
+        default=True,
+    ) # type: ignore
+
     def get_vb_ib_paths(self):
         buffer_pattern = re.compile(r'''-(?:ib|vb[0-9]+)(?P<hash>=[0-9a-f]+)?(?=[^0-9a-f=])''')
 
@@ -525,7 +736,9 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
                 raise Fatal(
                     'Unable to find corresponding buffers from filename - ensure you are loading a dump from a timestamped Frame Analysis directory (not a deduped directory)')
 
-            use_bin = False
+            # When the filename has a hash the .txt header describes this draw call completely, so only that
+            # part of the .buf is used. Without one the .txt may be incomplete and the whole .buf is loaded.
+            use_bin = draw_call_only = self.prefer_buf and bool(match.group('hash'))
             if not match.group('hash') and not use_bin:
                 self.report({'INFO'},
                             'Filename did not contain hash - if Frame Analysis dumped a custom resource the .txt file may be incomplete, Using .buf files instead')
@@ -546,7 +759,7 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
                     vb_paths = list(zip(vb_bin_paths, vb_paths))
                 else:
                     self.report({'WARNING'}, 'Corresponding .buf files not found - using .txt files')
-                    use_bin = False
+                    use_bin = draw_call_only = False
 
             # if self.pose_cb:
             #     pose_pattern = filename[:match.start()] + '*-' + self.pose_cb + '=*.txt'
@@ -559,7 +772,7 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
                 raise Fatal(
                     'Only draw calls using a single vertex buffer and a single index buffer are supported for now')
 
-            ret.add((vb_paths[0], ib_paths[0], use_bin))
+            ret.add((vb_paths[0], ib_paths[0], use_bin, draw_call_only))
         return ret
 
     def execute(self, context):
@@ -573,7 +786,8 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
 
         try:
             keywords = self.as_keywords(
-                ignore=('filepath', 'files', 'filter_glob', 'load_related', 'load_buf', 'pose_cb','directory'))
+                ignore=('filepath', 'files', 'filter_glob', 'load_related', 'load_buf', 'pose_cb', 'directory',
+                        'prefer_buf'))
             paths = self.get_vb_ib_paths()
             self.report({'INFO'}, "test：" + str(paths))
             import_3dmigoto(self, context, paths, **keywords)
@@ -583,7 +797,7 @@ class Import3DMigotoFrameAnalysis(bpy.types.Operator, ImportHelper, IOOBJOrienta
 
 
 def import_3dmigoto_raw_buffers(operator, context, vb_fmt_path, ib_fmt_path, vb_path=None, ib_path=None, **kwargs):
-    paths = (((vb_path, vb_fmt_path), (ib_path, ib_fmt_path), True),)
+    paths = (((vb_path, vb_fmt_path), (ib_path, ib_fmt_path), True, False),)
     return import_3dmigoto(operator, context, paths, **kwargs)
 
 
@@ -612,6 +826,12 @@ class Import3DMigotoRaw(bpy.types.Operator, ImportHelper, IOOBJOrientationHelper
         default=True,
     ) # type: ignore
 
+    compact_vertices: BoolProperty(
+        name="Remove unused vertices",
+        description="Only import the vertices the index buffer uses, the original vertex numbers are stored on the object so the export can restore them",
+        default=False,
+    ) # type: ignore
+
     def get_vb_ib_paths(self, filename):
         vb_bin_path = os.path.splitext(filename)[0] + '.vb'
         ib_bin_path = os.path.splitext(filename)[0] + '.ib'
@@ -0,0 +1,256 @@
+from .migoto_format import *
+
+import numpy
+import collections
+
+
+'''
+导出时对IB和VB进行优化的处理，全部都是纯numpy的计算，不依赖bpy。
+'''
+
+# R16_UINT能表示的最大顶点数量，trianglelist不使用strip cut，所以0xFFFF也是可以使用的索引
+R16_MAX_VERTICES = 65536
+
+
+def smallest_index_format(vertex_count):
+    if vertex_count <= R16_MAX_VERTICES:
+        return 'DXGI_FORMAT_R16_UINT'
+    return 'DXGI_FORMAT_R32_UINT'
+
+
+def morton_codes(points, bits=10):
+    """Z-order curve code of every point, each axis quantized to bits over the bounding box of the points"""
+    points = numpy.asarray(points, dtype=numpy.float64)[:, :3]
+    if len(points) == 0:
+        return numpy.empty(0, dtype=numpy.int64)
+    low = points.min(axis=0)
+    extent = points.max(axis=0) - low
+    extent[extent == 0.0] = 1.0
+    quantized = ((points - low) / extent * ((1 << bits) - 1)).astype(numpy.int64)
+    codes = numpy.zeros(len(points), dtype=numpy.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((quantized[:, axis] >> bit) & 1) << (bit * 3 + axis)
+    return codes
+
+
+def greedy_chunk_bounds(faces, max_vertices):
+    """
+    Walks the faces in order and starts a new chunk whenever the next face would take the number of
+    distinct vertices in the current chunk over max_vertices. Returns the face index each chunk starts at
+    followed by the total face count.
+    """
+    last_chunk = [-1] * (int(faces.max(initial=-1)) + 1)
+    bounds = [0]
+    chunk = 0
+    count = 0
+    for i, face in enumerate(faces.tolist()):
+        new = [v for v in set(face) if last_chunk[v] != chunk]
+        if count + len(new) > max_vertices:
+            chunk += 1
+            bounds.append(i)
+            count = 0
+            new = set(face)
+        for v in new:
+            last_chunk[v] = chunk
+        count += len(new)
+    bounds.append(len(faces))
+    return bounds
+
+
+def split_index_buffer(faces, positions, max_vertices=R16_MAX_VERTICES):
+    """
+    Splits a mesh into draw calls whose vertices each fit in an R16 index range. The faces are sorted along
+    a Morton curve of their centroids so every chunk is a spatially compact piece of the mesh, then every
+    chunk gets its own contiguous copy of the vertices it uses (vertices on chunk borders are duplicated).
+
+    Returns the old vertex index of every new vertex, the new faces (absolute indices into the new vertex
+    order, see IndexBuffer.chunks for how they are rebased when written) and one
+    (first index, index count, base vertex, vertex count) tuple per chunk.
+    """
+    faces = numpy.asarray(faces, dtype=numpy.int64).reshape(-1, 3)
+    centroids = numpy.asarray(positions, dtype=numpy.float64)[:, :3][faces].mean(axis=1)
+    faces = faces[numpy.argsort(morton_codes(centroids), kind='stable')]
+    bounds = greedy_chunk_bounds(faces, max_vertices)
+
+    vertex_map = []
+    new_faces = []
+    chunks = []
+    base_vertex = 0
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        indices = faces[start:end].ravel()
+        first, local = first_seen_unique(indices)
+        vertex_map.append(indices[first])
+        new_faces.append(local + base_vertex)
+        chunks.append((start * 3, (end - start) * 3, base_vertex, len(first)))
+        base_vertex += len(first)
+
+    if not chunks:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty((0, 3), dtype=numpy.int64), []
+    return numpy.concatenate(vertex_map), numpy.concatenate(new_faces).reshape(-1, 3), chunks
+
+
+# 模拟的GPU post-transform顶点缓存大小，Tipsify和ACMR/ATVR统计都使用这个值
+VERTEX_CACHE_SIZE = 16
+
+
+def fifo_cache_misses(faces, cache_size=VERTEX_CACHE_SIZE):
+    """Number of vertex shader invocations drawing the faces in order takes with a FIFO post-transform cache"""
+    cache = collections.deque()
+    cached = set()
+    misses = 0
+    for v in numpy.asarray(faces).ravel().tolist():
+        if v not in cached:
+            misses += 1
+            cache.append(v)
+            cached.add(v)
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+    return misses
+
+
+def vertex_cache_statistics(faces, cache_size=VERTEX_CACHE_SIZE):
+    """
+    ACMR (average cache miss ratio, transformed vertices per triangle) and ATVR (average transform to vertex
+    ratio, transformed vertices per referenced vertex, 1.0 is optimal) of the faces
+    """
+    faces = numpy.asarray(faces).reshape(-1, 3)
+    if len(faces) == 0:
+        return 0.0, 0.0
+    misses = fifo_cache_misses(faces, cache_size)
+    return misses / len(faces), misses / len(numpy.unique(faces))
+
+
+def tipsify(faces, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Linear time triangle reordering for the post-transform vertex cache, from "Fast Triangle Reordering for
+    Vertex Locality and Reduced Overdraw" (Sander, Nehab, Barczak 2007). Fans around a vertex, then moves on
+    to the neighbouring vertex that has been in the cache the longest while its remaining triangles still fit.
+    Returns the new order of the faces, only the order changes, never the faces themselves.
+    """
+    faces = numpy.asarray(faces, dtype=numpy.int64).reshape(-1, 3)
+    indices = faces.ravel()
+    # 顶点到三角形的邻接表（CSR格式）
+    triangle_of_index = numpy.repeat(numpy.arange(len(faces)), 3)
+    order = numpy.argsort(indices, kind='stable')
+    adjacency = triangle_of_index[order].tolist()
+    offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(indices, minlength=vertex_count)))).tolist()
+
+    face_list = faces.tolist()
+    live = numpy.bincount(indices, minlength=vertex_count).tolist()
+    cache_time = [-cache_size - 1] * vertex_count
+    emitted = [False] * len(face_list)
+    dead_end = []
+    output = []
+    time = 0
+    cursor = 0
+
+    def skip_dead_end():
+        nonlocal cursor
+        while dead_end:
+            v = dead_end.pop()
+            if live[v] > 0:
+                return v
+        while cursor < vertex_count:
+            if live[cursor] > 0:
+                return cursor
+            cursor += 1
+        return -1
+
+    fanning = skip_dead_end()
+    while fanning >= 0:
+        candidates = []
+        for t in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            output.append(t)
+            for v in face_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+
+        best = -1
+        best_priority = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = time - cache_time[v]
+                if priority > best_priority:
+                    best = v
+                    best_priority = priority
+        fanning = best if best >= 0 else skip_dead_end()
+
+    return numpy.array(output, dtype=numpy.int64)
+
+
+def optimize_vertex_cache(faces, chunks, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Runs tipsify over every draw call of an index buffer separately (the whole buffer when there are no
+    chunks), faces never move between draw calls. Returns the reordered faces.
+    """
+    faces = numpy.array(faces, dtype=numpy.int64).reshape(-1, 3)
+    for first, count, base_vertex, chunk_vertex_count in chunks or [(0, len(faces) * 3, 0, vertex_count)]:
+        draw = faces[first // 3:(first + count) // 3]
+        draw[:] = draw[tipsify(draw - base_vertex, chunk_vertex_count, cache_size)]
+    return faces
+
+
+def reorder_vertices_by_first_use(faces, vertex_count):
+    """
+    Vertex fetch locality: numbers the vertices in the order the index buffer first uses them, vertices the
+    index buffer never uses go last in their old order. Draw call chunks keep their vertex ranges, since
+    their vertices are contiguous and used one chunk after another.
+    Returns the old index of every new vertex and the faces remapped to the new numbering.
+    """
+    faces = numpy.asarray(faces, dtype=numpy.int64).reshape(-1, 3)
+    indices = faces.ravel()
+    first, _ = first_seen_unique(indices)
+    used = indices[first]
+    unused = numpy.ones(vertex_count, dtype=bool)
+    unused[used] = False
+    new_to_old = numpy.concatenate((used, numpy.flatnonzero(unused)))
+    old_to_new = numpy.empty(vertex_count, dtype=numpy.int64)
+    old_to_new[new_to_old] = numpy.arange(vertex_count)
+    return new_to_old, old_to_new[faces]
+
+
+def quantize_columns(columns, tolerances):
+    """
+    Deduplication keys for weld_vertices: float semantics that start with one of the tolerances keys are
+    rounded to a multiple of that tolerance, everything else is compared exactly.
+    """
+    keys = collections.OrderedDict()
+    for semantic, data in columns.items():
+        data = numpy.asarray(data)
+        tolerance = next((t for prefix, t in tolerances.items() if semantic.startswith(prefix)), 0.0)
+        if tolerance > 0.0 and data.dtype.kind == 'f':
+            data = numpy.around(data.astype(numpy.float64) / tolerance).astype(numpy.int64)
+        keys[semantic] = data
+    return keys
+
+
+def weld_vertices(columns, steps):
+    """
+    deduplicate_vertices with per semantic tolerances. steps is a list of (label, semantic prefixes,
+    tolerance), the tolerances are applied one after another so the vertices every step saved can be
+    reported, a tolerance of 0 leaves those semantics exact. Only the keys are quantized, every vertex keeps
+    the values of the first loop that was merged into it.
+    Returns the same as deduplicate_vertices plus a (label, vertices saved) tuple for every active step.
+    """
+    vertex_loops, loop_vertex_indices = deduplicate_vertices(columns)
+    tolerances = collections.OrderedDict()
+    saved = []
+    for label, prefixes, tolerance in steps:
+        if tolerance <= 0.0:
+            continue
+        for prefix in prefixes:
+            tolerances[prefix] = tolerance
+        vertex_count = len(vertex_loops)
+        vertex_loops, loop_vertex_indices = deduplicate_vertices(quantize_columns(columns, tolerances))
+        saved.append((label, vertex_count - len(vertex_loops)))
+    return vertex_loops, loop_vertex_indices, saved
@@ -0,0 +1,126 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+import numpy
+
+
+'''
+导出文件统一通过这里写出。先写到同一个文件夹下的临时文件，写完之后再用os.replace原子替换，
+这样导出中途崩溃也不会留下只写了一半的文件；内容和已有文件完全一样时直接丢弃临时文件，
+不去动原来的文件，避免3DMigoto重新加载以及杀毒软件重新扫描。
+'''
+
+# 比较文件内容时每次读取的大小
+HASH_CHUNK_SIZE = 1 << 20
+
+# 差异报告最多列出多少个字节区间
+DIFF_REPORT_RANGES = 16
+
+
+def file_digest(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def same_file_contents(path_a, path_b):
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    return file_digest(path_a) == file_digest(path_b)
+
+
+def changed_byte_ranges(old_path, new_path):
+    """The [start, end) byte ranges in which two files differ, bytes past the end of the shorter file count as changed"""
+    old = numpy.fromfile(old_path, dtype=numpy.uint8)
+    new = numpy.fromfile(new_path, dtype=numpy.uint8)
+    common = min(len(old), len(new))
+    changed = numpy.flatnonzero(old[:common] != new[:common])
+    ranges = []
+    if len(changed):
+        breaks = numpy.flatnonzero(numpy.diff(changed) > 1)
+        starts = numpy.concatenate(([changed[0]], changed[breaks + 1]))
+        ends = numpy.concatenate((changed[breaks], [changed[-1]])) + 1
+        ranges = list(zip(starts.tolist(), ends.tolist()))
+    if len(old) != len(new):
+        ranges.append((common, max(len(old), len(new))))
+    return ranges
+
+
+class AtomicOutput(object):
+    """
+    File like object for export output. Everything is streamed into a temporary file next to path, which
+    replaces path atomically on close, unless path already has exactly the same contents, in which case it
+    is left untouched. After closing, changed tells which of the two happened.
+    With diff_log the byte ranges that changed compared to the previous file are printed.
+    If the with block raises, the temporary file is removed and path is never touched.
+    """
+
+    def __init__(self, path, mode='wb', diff_log=False):
+        assert (mode in ('w', 'wb'))
+        self.name = path
+        self.diff_log = diff_log
+        self.changed = None
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                              suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        self.file = os.fdopen(fd, mode)
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def writelines(self, lines):
+        self.file.writelines(lines)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        try:
+            if os.path.exists(self.name):
+                if same_file_contents(self.name, self.temp_path):
+                    self.changed = False
+                    return
+                if self.diff_log:
+                    self.log_changes()
+            self.changed = True
+            # mkstemp只给了当前用户读写权限，保持和原来的文件（或者普通新建的文件）一样的权限
+            if os.path.exists(self.name):
+                shutil.copymode(self.name, self.temp_path)
+            else:
+                os.chmod(self.temp_path, 0o644)
+            os.replace(self.temp_path, self.name)
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+    def log_changes(self):
+        ranges = changed_byte_ranges(self.name, self.temp_path)
+        print('NOTICE: %s: %i changed byte ranges, %i bytes' % (self.name, len(ranges), sum(end - start for start, end in ranges)))
+        for start, end in ranges[:DIFF_REPORT_RANGES]:
+            print('    [0x%08x, 0x%08x)' % (start, end))
+        if len(ranges) > DIFF_REPORT_RANGES:
+            print('    ...')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+
+def write_if_changed(path, data, diff_log=False):
+    """Writes bytes or str to path through AtomicOutput, returns whether the file changed"""
+    with AtomicOutput(path, 'wb' if isinstance(data, (bytes, bytearray, memoryview)) else 'w', diff_log) as f:
+        f.write(data)
+    return f.changed
@@ -1,4 +1,7 @@
 import re
+import os
+import mmap
+import warnings
 import numpy
 import operator  # to get function names for operators like @, +, -
 import struct
@@ -44,6 +47,31 @@ class Fatal(Exception):
     pass
 
 
+def parse_text_array(text, dtype, sep):
+    """
+    Converts a string of separated numbers with numpy's C level text parser. Depending on the numpy
+    version trailing garbage is either a DeprecationWarning or a ValueError, both become Fatal here.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return numpy.fromstring(text, dtype=dtype, sep=sep)
+        except (ValueError, DeprecationWarning) as e:
+            raise Fatal('Unable to parse buffer text data: %s' % e)
+
+
+def map_binary_file(path):
+    """
+    Memory maps a .vb/.ib/.buf file read only, so numpy views can be created over it without reading
+    the parts that are never used. The mapping stays alive for as long as any view over it does.
+    """
+    with open(path, 'rb') as f:
+        # mmap refuses to map empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 '''
 DXGI Formats but why use this unreadable format ?
 '''
@@ -64,60 +92,81 @@ misc_float_pattern = re.compile(r'''(?:DXGI_FORMAT_)?(?:[RGBAD][0-9]+)+_(?:FLOAT
 misc_int_pattern = re.compile(r'''(?:DXGI_FORMAT_)?(?:[RGBAD][0-9]+)+_[SU]INT''')
 
 
-# TODO strange design and hard to read and understand for mod author, make this easier and more readable later.
-def EncoderDecoder(fmt):
-    if f32_pattern.match(fmt):
-        return (lambda data: b''.join(struct.pack('<f', x) for x in data),
-                lambda data: numpy.frombuffer(data, numpy.float32).tolist())
-    if f16_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.float16).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.float16).tolist())
-    if u32_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.uint32).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.uint32).tolist())
-    if u16_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.uint16).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.uint16).tolist())
-    if u8_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.uint8).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.uint8).tolist())
-    if s32_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.int32).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.int32).tolist())
-    if s16_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.int16).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.int16).tolist())
-    if s8_pattern.match(fmt):
-        return (lambda data: numpy.fromiter(data, numpy.int8).tobytes(),
-                lambda data: numpy.frombuffer(data, numpy.int8).tolist())
-
-    if unorm16_pattern.match(fmt):
-        return (
-            lambda data: numpy.around((numpy.fromiter(data, numpy.float32) * 65535.0)).astype(numpy.uint16).tobytes(),
-            lambda data: (numpy.frombuffer(data, numpy.uint16) / 65535.0).tolist())
-    if unorm8_pattern.match(fmt):
-        return (lambda data: numpy.around((numpy.fromiter(data, numpy.float32) * 255.0)).astype(numpy.uint8).tobytes(),
-                lambda data: (numpy.frombuffer(data, numpy.uint8) / 255.0).tolist())
-    if snorm16_pattern.match(fmt):
-        return (
-            lambda data: numpy.around((numpy.fromiter(data, numpy.float32) * 32767.0)).astype(numpy.int16).tobytes(),
-            lambda data: (numpy.frombuffer(data, numpy.int16) / 32767.0).tolist())
-    if snorm8_pattern.match(fmt):
-        return (lambda data: numpy.around((numpy.fromiter(data, numpy.float32) * 127.0)).astype(numpy.int8).tobytes(),
-                lambda data: (numpy.frombuffer(data, numpy.int8) / 127.0).tolist())
-
-    raise Fatal('File uses an unsupported DXGI Format: %s' % fmt)
-
-
 # TODO strange design again ,why don't use a class to wrap all encode and decode??
 components_pattern = re.compile(r'''(?<![0-9])[0-9]+(?![0-9])''')
 
 
+class DXGIFormat(object):
+    """
+    Immutable description of a DXGI format string, parsed once by dxgi_format() so the hot paths in
+    import/export never have to run the regular expressions above again.
+
+    dtype is the little endian numpy dtype of a single component and scale is what the stored integers
+    are divided by for UNORM/SNORM formats (None otherwise). Both are None for formats without a numpy
+    equivalent, such as packed R10G10B10A2 formats, while components/size are still valid.
+    """
+    __slots__ = ('format', 'components', 'size', 'dtype', 'scale', 'kind', 'is_float', 'is_int')
+
+    _numpy_formats = (
+        (f32_pattern, '<f4', None, 'float'),
+        (f16_pattern, '<f2', None, 'float'),
+        (u32_pattern, '<u4', None, 'uint'),
+        (u16_pattern, '<u2', None, 'uint'),
+        (u8_pattern, 'u1', None, 'uint'),
+        (s32_pattern, '<i4', None, 'sint'),
+        (s16_pattern, '<i2', None, 'sint'),
+        (s8_pattern, 'i1', None, 'sint'),
+        (unorm16_pattern, '<u2', 65535.0, 'unorm'),
+        (unorm8_pattern, 'u1', 255.0, 'unorm'),
+        (snorm16_pattern, '<i2', 32767.0, 'snorm'),
+        (snorm8_pattern, 'i1', 127.0, 'snorm'),
+    )
+
+    def __init__(self, fmt):
+        matches = components_pattern.findall(fmt)
+        dtype = scale = kind = None
+        # The first pattern that matches wins:
+        for pattern, numpy_dtype, numpy_scale, numpy_kind in self._numpy_formats:
+            if pattern.match(fmt):
+                dtype, scale, kind = numpy.dtype(numpy_dtype), numpy_scale, numpy_kind
+                break
+        set_slot = super().__setattr__
+        set_slot('format', fmt)
+        set_slot('components', len(matches))
+        set_slot('size', sum(map(int, matches)) // 8)
+        set_slot('dtype', dtype)
+        set_slot('scale', scale)
+        set_slot('kind', kind)
+        set_slot('is_float', misc_float_pattern.match(fmt) is not None)
+        set_slot('is_int', misc_int_pattern.match(fmt) is not None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DXGIFormat is immutable')
+
+    def __repr__(self):
+        return 'DXGIFormat(%r)' % self.format
+
+    def numpy_dtype(self):
+        if self.dtype is None:
+            raise Fatal('File uses an unsupported DXGI Format: %s' % self.format)
+        return self.dtype
+
+
+_dxgi_formats = {}
+
+
+def dxgi_format(fmt):
+    try:
+        return _dxgi_formats[fmt]
+    except KeyError:
+        descriptor = _dxgi_formats[fmt] = DXGIFormat(fmt)
+        return descriptor
+
+
 def format_components(fmt):
-    return len(components_pattern.findall(fmt))
+    return dxgi_format(fmt).components
 
 
 def format_size(fmt):
-    matches = components_pattern.findall(fmt)
-    return sum(map(int, matches)) // 8
+    return dxgi_format(fmt).size
 
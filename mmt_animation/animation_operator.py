@@ -79,8 +79,7 @@ class MMDModIniGenerator(bpy.types.Operator):
                         vst += struct.pack("f", bone.matrix_channel[i][j])
             result += vst
 
-        with open(output_bonematrix_file_path, "wb") as f:
-            f.write(result)
+        write_if_changed(output_bonematrix_file_path, result)
 
         # 然后需要获取一下顶点组数量
         vertex_group_number = len(bpy.data.objects[mesh_name].vertex_groups)
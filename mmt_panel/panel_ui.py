@@ -1,6 +1,8 @@
 import os
 import bpy
 import json
+import time
+import concurrent.futures
 
 from .panel_functions import *
 
@@ -40,6 +42,9 @@ class MMTImportAllTextModel(bpy.types.Operator):
 
         # self.report({'INFO'}, "读取到的drawIB文件夹总数量：" + str(len(import_folder_path_list)))
 
+        # 分两个阶段导入：第一阶段只收集文件并在线程池中解码所有的ib vb文件，这一步完全不需要bpy，
+        # 第二阶段在主线程中创建Blender的mesh和物体，这样解码时间就不会再一个文件一个文件地累加起来
+        import_jobs = []
         for import_folder_path in import_folder_path_list:
             # TODO 在这里导入当前文件夹下所有的ib vb文件
             # 1.我们需要添加到一个新建的集合里，方便后续操作
@@ -70,7 +75,7 @@ class MMTImportAllTextModel(bpy.types.Operator):
                 ib_file_name = ib_file_name[0:len(ib_file_name) - 3]
                 prefix_set.add(ib_file_name)
             # 遍历并导入每一个ib vb文件
-            for prefix in prefix_set:
+            for prefix in sorted(prefix_set):
                 vb_bin_path = import_folder_path + "\\" + prefix + '.vb'
                 ib_bin_path = import_folder_path + "\\" + prefix + '.ib'
                 fmt_path = import_folder_path + "\\" + prefix + '.fmt'
@@ -79,32 +84,40 @@ class MMTImportAllTextModel(bpy.types.Operator):
                 if not os.path.exists(ib_bin_path):
                     raise Fatal('Unable to find matching .ib file for %s' % import_folder_path + "\\" + prefix)
                 if not os.path.exists(fmt_path):
-                    fmt_path = None
-
-                # 一些需要传递过去的参数，反正这里传空的是可以用的
-                migoto_raw_import_options = {}
-
-                # 这里使用一个done的set来记录已经处理过的文件路径，如果处理过就会在里面触发continue
-                done = set()
-                try:
-                    if os.path.normcase(vb_bin_path) in done:
-                        continue
-                    done.add(os.path.normcase(vb_bin_path))
-                    if fmt_path is not None:
-                        obj_results = import_3dmigoto_raw_buffers(self, context, fmt_path, fmt_path, vb_path=vb_bin_path,
-                                                                  ib_path=ib_bin_path, **migoto_raw_import_options)
-                        # 虽然复制之后名字会多个001 002这种，但是不影响正常使用，只要能达到效果就行了
-                        for obj in obj_results:
-                            new_object = obj.copy()
-                            new_object.data = obj.data.copy()
-
-                            collection.objects.link(new_object)
-                            bpy.data.objects.remove(obj)
-                    else:
-                        self.report({'ERROR'}, "Can't find .fmt file!")
-                except Fatal as e:
-                    self.report({'ERROR'}, str(e))
+                    self.report({'ERROR'}, "Can't find .fmt file!")
+                    continue
 
+                # 和import_3dmigoto_raw_buffers一样，.fmt文件同时作为vb和ib的格式参考
+                paths = (((vb_bin_path, fmt_path), (ib_bin_path, fmt_path), True, False),)
+                import_jobs.append((collection, paths))
+
+        # 第一阶段：在线程池中解码，numpy的大部分操作和文件读取都会释放GIL
+        decode_start = time.time()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [executor.submit(decode_3dmigoto_mesh_deferred, paths) for collection, paths in import_jobs]
+            concurrent.futures.wait(futures)
+        decode_time = time.time() - decode_start
+
+        # 第二阶段：在主线程中创建mesh
+        build_start = time.time()
+        for (collection, paths), future in zip(import_jobs, futures):
+            decoded, reports, error = future.result()
+            reports.replay(self)
+            try:
+                if error is not None:
+                    raise error
+                obj = build_3dmigoto_mesh(self, context, decoded, os.path.dirname(paths[0][0][0]))
+                # 虽然复制之后名字会多个001 002这种，但是不影响正常使用，只要能达到效果就行了
+                new_object = obj.copy()
+                new_object.data = obj.data.copy()
+
+                collection.objects.link(new_object)
+                bpy.data.objects.remove(obj)
+            except Fatal as e:
+                self.report({'ERROR'}, str(e) + ': ' + str(paths[0][:2]))
+        build_time = time.time() - build_start
+
+        self.report({'INFO'}, "一键导入%i个模型：解码用时%.3fs，创建模型用时%.3fs" % (len(import_jobs), decode_time, build_time))
         return {'FINISHED'}
 
 
@@ -112,6 +125,14 @@ class MMTExportAllIBVBModel(bpy.types.Operator):
     bl_idname = "mmt.export_all"
     bl_label = "Export all .ib and .vb model to current OutputFolder"
 
+    force_full: bpy.props.BoolProperty(
+        name="Force Full Export",
+        description="Export every object of the collection, even the ones that didn't change since the last export",
+        default=False,
+        # 不保存上一次的值，否则强制导出一次之后普通的一键导出也会一直强制导出
+        options={'SKIP_SAVE'},
+    ) # type: ignore
+
     def execute(self, context):
         # 首先根据MMT路径，获取
         mmt_path = bpy.context.scene.mmt_props.path
@@ -131,41 +152,65 @@ class MMTExportAllIBVBModel(bpy.types.Operator):
         # 获取当前选中的对象列表
         selected_collection = bpy.context.collection
 
+        # 每个DrawIB文件夹一个manifest，记录上次导出时的指纹，指纹没变并且文件都还在的部位直接跳过
+        manifests = {}
+
         # 遍历选中的对象
         export_time = 0
-        for obj in selected_collection.objects:
-            # 判断对象是否为网格对象
-            if obj.type == 'MESH':
-                export_time = export_time + 1
-                bpy.context.view_layer.objects.active = obj
-                mesh = obj.data  # 获取网格数据
-
-                self.report({'INFO'}, "export name: " + mesh.name)
-
-                # 处理当前网格对象
-                # 例如，打印网格名称
-
-                name_splits = str(mesh.name).split("-")
-                draw_ib = name_splits[0]
-                draw_index = name_splits[1]
-                draw_index = draw_index[0:len(draw_index) - 3]
-                if draw_index.endswith(".vb."):
-                    draw_index = draw_index[0:len(draw_index) - 4]
-
-                # 设置类属性的值
-                vb_path = output_folder_path + draw_ib + "\\" + draw_index + ".vb"
-                self.report({'INFO'}, "export path: " + vb_path)
+        skip_time = 0
+        try:
+            for obj in selected_collection.objects:
+                # 判断对象是否为网格对象
+                if obj.type == 'MESH':
+                    export_time = export_time + 1
+                    bpy.context.view_layer.objects.active = obj
+                    mesh = obj.data  # 获取网格数据
+
+                    self.report({'INFO'}, "export name: " + mesh.name)
+
+                    # 处理当前网格对象
+                    # 例如，打印网格名称
+
+                    name_splits = str(mesh.name).split("-")
+                    draw_ib = name_splits[0]
+                    draw_index = name_splits[1]
+                    draw_index = draw_index[0:len(draw_index) - 3]
+                    if draw_index.endswith(".vb."):
+                        draw_index = draw_index[0:len(draw_index) - 4]
+
+                    # 设置类属性的值
+                    vb_path = output_folder_path + draw_ib + "\\" + draw_index + ".vb"
+                    self.report({'INFO'}, "export path: " + vb_path)
+
+                    ib_path = os.path.splitext(vb_path)[0] + '.ib'
+                    fmt_path = os.path.splitext(vb_path)[0] + '.fmt'
+
+                    draw_ib_folder = output_folder_path + draw_ib
+                    if draw_ib_folder not in manifests:
+                        manifests[draw_ib_folder] = load_export_manifest(draw_ib_folder)
+                    manifest = manifests[draw_ib_folder]
+
+                    fingerprint = export_fingerprint(context, obj)
+                    if not self.force_full and manifest.get(draw_index) == fingerprint and \
+                            all(os.path.exists(path) for path in (vb_path, ib_path, fmt_path)):
+                        skip_time = skip_time + 1
+                        self.report({'INFO'}, "unchanged, skipped: " + mesh.name)
+                        continue
 
-                ib_path = os.path.splitext(vb_path)[0] + '.ib'
-                fmt_path = os.path.splitext(vb_path)[0] + '.fmt'
+                    # FIXME: ExportHelper will check for overwriting vb_path, but not ib_path
 
-                # FIXME: ExportHelper will check for overwriting vb_path, but not ib_path
+                    # 导出之前先去掉旧的指纹，导出失败时下次就一定会重新导出
+                    manifest.pop(draw_index, None)
+                    export_3dmigoto(self, context, vb_path, ib_path, fmt_path)
+                    manifest[draw_index] = fingerprint
+        finally:
+            for draw_ib_folder, manifest in manifests.items():
+                save_export_manifest(draw_ib_folder, manifest)
 
-                export_3dmigoto(self, context, vb_path, ib_path, fmt_path)
         if export_time == 0:
             self.report({'ERROR'}, "导出失败！请选择一个集合后再点一键导出！")
         else:
-            self.report({'INFO'}, "一键导出成功！成功导出的部位数量：" + str(export_time))
+            self.report({'INFO'}, "一键导出成功！成功导出的部位数量：" + str(export_time - skip_time) + " 未改动跳过的部位数量：" + str(skip_time))
         return {'FINISHED'}
 
 
@@ -183,6 +228,103 @@ class MMTPathProperties(bpy.types.PropertyGroup):
         default=False
     ) # type: ignore
 
+    export_tangent_mode: bpy.props.EnumProperty(
+        name="Tangent Unification",
+        description="How loops sharing a position and normal get a single tangent when the vertex number is kept",
+        items=(('FIRST', "First", "Use the tangent of the first loop of the vertex, same as older versions"),
+               ('AVERAGE', "Average", "Use the renormalized average tangent of all loops of the vertex")),
+        default='FIRST'
+    ) # type: ignore
+
+    export_ib_format: bpy.props.EnumProperty(
+        name="IB Format",
+        description="Index buffer format used when exporting",
+        items=(('LEGACY', "R32", "Always export R16 index buffers as R32_UINT, same as older versions"),
+               ('SMALLEST', "Smallest", "Use R16_UINT whenever the vertex count allows it")),
+        default='LEGACY'
+    ) # type: ignore
+
+    export_ib_chunking: bpy.props.BoolProperty(
+        name="Split Into R16 Draw Calls",
+        description="With the Smallest IB format, split meshes with more than 65536 vertices into spatially compact R16 draw calls, the draw call ranges are written to the .fmt file",
+        default=False
+    ) # type: ignore
+
+    export_optimize_vertex_cache: bpy.props.BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder the exported triangles for the GPU post-transform vertex cache (Tipsify), the vertices are not changed",
+        default=False
+    ) # type: ignore
+
+    export_reorder_vertices: bpy.props.BoolProperty(
+        name="Reorder Vertices By First Use",
+        description="Reorder the exported vertices in the order the index buffer first uses them and write the permutation to a .vbremap.json file",
+        default=False
+    ) # type: ignore
+
+    export_weld_position: bpy.props.FloatProperty(
+        name="Position Weld Tolerance",
+        description="Merge exported vertices whose POSITION differs by less than this, 0 only merges identical values",
+        default=0.0,
+        min=0.0,
+        precision=6
+    ) # type: ignore
+
+    export_weld_normal: bpy.props.FloatProperty(
+        name="Normal Weld Tolerance",
+        description="Merge exported vertices whose NORMAL and TANGENT differ by less than this, 0 only merges identical values",
+        default=0.0,
+        min=0.0,
+        precision=6
+    ) # type: ignore
+
+    export_weld_texcoord: bpy.props.FloatProperty(
+        name="TEXCOORD Weld Tolerance",
+        description="Merge exported vertices whose TEXCOORD differs by less than this, 0 only merges identical values",
+        default=0.0,
+        min=0.0,
+        precision=6
+    ) # type: ignore
+
+    export_log_byte_diff: bpy.props.BoolProperty(
+        name="Log Changed Byte Ranges",
+        description="Print which byte ranges of every rewritten export file changed compared to the previous export",
+        default=False
+    ) # type: ignore
+
+    export_streaming: bpy.props.BoolProperty(
+        name="Streaming Export",
+        description="Build, deduplicate and write the exported buffers in chunks of loops to bound memory use on very large meshes. The IB format, vertex cache and vertex reorder options are not available in this mode",
+        default=False
+    ) # type: ignore
+
+    export_streaming_chunk_size: bpy.props.IntProperty(
+        name="Streaming Chunk Size",
+        description="Number of loops processed per chunk by the streaming export",
+        default=786432,
+        min=3
+    ) # type: ignore
+
+    export_restore_vertex_numbering: bpy.props.BoolProperty(
+        name="Restore Vertex Numbering",
+        description="For objects imported with unused vertices removed, export every vertex at its original index, needs the exported vertices to match the Blender vertices one to one",
+        default=False
+    ) # type: ignore
+
+    export_normalize_weights: bpy.props.BoolProperty(
+        name="Normalize Blend Weights",
+        description="Renormalize the exported blend weights of every vertex so they sum to 1 after the strongest influences the layout has room for were picked",
+        default=False
+    ) # type: ignore
+
+    export_weight_threshold: bpy.props.FloatProperty(
+        name="Blend Weight Threshold",
+        description="Vertex group weights below this value are dropped before picking the exported influences, 0 keeps all of them",
+        default=0.0,
+        min=0.0,
+        max=1.0
+    ) # type: ignore
+
     def __init__(self) -> None:
         super().__init__()
         self.subtype = 'DIR_PATH'
@@ -247,6 +389,20 @@ class MMTPanel(bpy.types.Panel):
         # 绘制一个CheckBox用来存储是否导出相同顶点数
         layout.separator()
         layout.prop(context.scene.mmt_props, "export_same_number", text="导出不改变顶点数")
+        layout.prop(context.scene.mmt_props, "export_tangent_mode", text="切线合并方式")
+        layout.prop(context.scene.mmt_props, "export_normalize_weights", text="导出时归一化权重")
+        layout.prop(context.scene.mmt_props, "export_ib_format", text="IB格式")
+        layout.prop(context.scene.mmt_props, "export_ib_chunking", text="超过65536顶点时拆分为多个R16 DrawCall")
+        layout.prop(context.scene.mmt_props, "export_optimize_vertex_cache", text="导出时优化顶点缓存(三角形排序)")
+        layout.prop(context.scene.mmt_props, "export_reorder_vertices", text="导出时按IB使用顺序重排顶点")
+        layout.prop(context.scene.mmt_props, "export_restore_vertex_numbering", text="导出时还原导入前的顶点编号")
+        layout.prop(context.scene.mmt_props, "export_weld_position", text="POSITION合并容差")
+        layout.prop(context.scene.mmt_props, "export_weld_normal", text="NORMAL/TANGENT合并容差")
+        layout.prop(context.scene.mmt_props, "export_weld_texcoord", text="TEXCOORD合并容差")
+        layout.prop(context.scene.mmt_props, "export_log_byte_diff", text="输出导出文件的字节差异")
+        layout.prop(context.scene.mmt_props, "export_streaming", text="分块流式导出(超大模型)")
+        layout.prop(context.scene.mmt_props, "export_streaming_chunk_size", text="流式导出分块大小")
+        layout.prop(context.scene.mmt_props, "export_weight_threshold", text="导出权重最小阈值")
 
         layout.separator()
         layout.label(text="在OutputFolder中导入或导出")
@@ -272,6 +428,8 @@ class MMTPanel(bpy.types.Panel):
 
         # 一键快速导出当前选中Collection中的所有model到对应的hash值文件夹中，并直接调用MMT.exe的Mod生成方法，做到导出完即可游戏里F10刷新看效果。
         operator_export_ibvb = self.layout.operator("mmt.export_all", text="一键导出选中的MMT集合")
+        operator_export_ibvb_full = self.layout.operator("mmt.export_all", text="强制全部重新导出选中的MMT集合")
+        operator_export_ibvb_full.force_full = True
 
         # 添加分隔符
         layout.separator()
@@ -343,44 +343,15 @@ def show_indexed_vertices(self, context):
         mesh_triangulate(mesh)
         mesh.calc_tangents()
 
-        texcoord_layers = {}
-        for uv_layer in mesh.uv_layers:
-            texcoords = {}
-            try:
-                flip_texcoord_v = obj['3DMigoto:' + uv_layer.name]['flip_v']
-                if flip_texcoord_v:
-                    flip_uv = lambda uv: (uv[0], 1.0 - uv[1])
-                else:
-                    flip_uv = lambda uv: uv
-            except KeyError:
-                flip_uv = lambda uv: uv
-
-            for l in mesh.loops:
-                uv = flip_uv(uv_layer.data[l.index].uv)
-                texcoords[l.index] = uv
-            texcoord_layers[uv_layer.name] = texcoords
-
-        indexed_vertices = collections.OrderedDict()
-        unique_position_vertices = {}
-
-        index_number = 0
-        for poly in mesh.polygons:
-            face = []
-            for blender_lvertex in mesh.loops[poly.loop_start:poly.loop_start + poly.loop_total]:
-                #
-                vertex = blender_vertex_to_3dmigoto_vertex(mesh, obj, blender_lvertex, layout, texcoord_layers)
-                if "POSITION" in vertex and "NORMAL" in vertex and "TANGENT" in vertex:
-                    if tuple(vertex["POSITION"] + vertex["NORMAL"]) in unique_position_vertices:
-                        tangent_var = unique_position_vertices[tuple(vertex["POSITION"] + vertex["NORMAL"])]
-                        vertex["TANGENT"] = tangent_var
-                    else:
-                        tangent_var = vertex["TANGENT"]
-                        unique_position_vertices[tuple(vertex["POSITION"] + vertex["NORMAL"])] = tangent_var
-                        vertex["TANGENT"] = tangent_var
-                index_number = index_number + 1
-                indexed_vertex = indexed_vertices.setdefault(HashableVertex(vertex), len(indexed_vertices))
-                face.append(indexed_vertex)
-        self.report({'INFO'}, "Original Indices:" + str(obj['3DMigoto:OriginalIndicesNumber']) + " Current Indices: " + str(index_number) + " Original Vertices:" + str(obj['3DMigoto:OriginalVertexNumber']) + "  Current Vertices: "+str(len(indexed_vertices)))
+        mmt_props = bpy.context.scene.mmt_props
+        loop_order = triangulated_loop_order(mesh)
+        loop_columns = gather_loop_attributes(mesh, obj, layout, mmt_props.export_normalize_weights,
+                                              mmt_props.export_weight_threshold, loop_order)
+        unify_tangents(loop_columns, mmt_props.export_tangent_mode)
+
+        index_number = len(loop_order)
+        vertex_loops, _, _ = weld_vertices(loop_columns, weld_steps(mmt_props))
+        self.report({'INFO'}, "Original Indices:" + str(obj['3DMigoto:OriginalIndicesNumber']) + " Current Indices: " + str(index_number) + " Original Vertices:" + str(obj['3DMigoto:OriginalVertexNumber']) + "  Current Vertices: "+str(len(vertex_loops)))
 
     return {'FINISHED'}
 